@@ -1,4 +1,4 @@
-import json
+import json, os
 
 MOVIE_FILEPATH = "data/movies.json"
 STOPWORDS_FILEPATH = "data/stopwords.txt"
@@ -6,18 +6,36 @@ GOLDEN_DATASET_FILEPATH = "data/golden_dataset.json"
 
 CACHE_DIR = "cache"
 DOC_LENGTHS_FILE = "doc_lengths.pkl"
-DOCMAP_FILE = "docmap.pkl"
+DOCUMENTS_FILE = "documents.npz"
 INDEX_FILE = "index.pkl"
+INDEX_VERSION_FILE = "index_version.txt"
 MOVIE_EMBEDDINGS_FILE = "movie_embeddings.npy"
+MOVIE_VECTOR_ROWS_FILE = "movie_vector_rows.npy"
 TERM_FREQ_FILE = "term_frequencies.pkl"
+IMPACTS_FILE = "bm25_impacts.pkl"
+BM25_CSR_FILE = "bm25_csr.npz"
+POSITIONS_FILE = "positions.pkl"
+SPELLING_FILE = "spelling.pkl"
+EXPANSIONS_FILE = "expansions.pkl"
 CHUNK_EMBEDDINGS_FILE = "chunk_embeddings.npy"
-CHUNK_METADATA_FILE = "chunk_metadata.json"
+CHUNK_METADATA_FILE = "chunk_metadata.npz"
+REDUCED_EMBEDDINGS_FILE = "chunk_embeddings_{dims}d.npz"
+SHARDS_DIR = "shards"
+SNAPSHOTS_DIR = "snapshots"
+CURRENT_SNAPSHOT_FILE = "CURRENT"
+SNAPSHOT_MANIFEST_FILE = "manifest.json"
+PROFILES_DIR = "profiles"
 
 def load_movies() -> dict[str, list[dict]]:
   with open(MOVIE_FILEPATH) as file:
     movie_data = json.load(file)
   return movie_data
 
+def ensure_writable_cache(cache_dir: str, reason: str):
+  # Published snapshots are read-only: a missing or stale file there means the snapshot has to be rebuilt
+  if os.path.exists(os.path.join(cache_dir, SNAPSHOT_MANIFEST_FILE)):
+    raise RuntimeError(f"Snapshot {cache_dir}: {reason}. Rebuild the snapshot with 'hybrid_search_cli.py snapshot-build'")
+
 def load_stopwords() -> list[str]:
   result = []
   with open(STOPWORDS_FILEPATH) as file:
@@ -1,56 +1,62 @@
 import argparse, json
 from data_handling import GOLDEN_DATASET_FILEPATH, load_movies
 from lib.hybrid_search import HybridSearch
+from lib.evaluation import evaluate_grid
+from lib.profiling import add_profile_arguments, profile_session
 
 def main():
   parser = argparse.ArgumentParser(description="Search Evaluation CLI")
+  add_profile_arguments(parser)
   parser.add_argument(
     "--limit",
     type=int,
-    default=5,
-    help="Number of results to evaluate (k for precision@k, recall@k)",
+    nargs="+",
+    default=[5],
+    help="Number of results to evaluate (k for precision@k, recall@k). Several values sweep the limit",
   )
+  parser.add_argument("--k", type=int, nargs="+", default=[60], help="RRF k values to sweep (default 60)")
+  parser.add_argument("--alpha", type=float, nargs="+", default=[], help="Weighted search alpha values to sweep (none by default)")
+  parser.add_argument("--workers", type=int, default=4, help="Golden queries retrieved in parallel (default 4)")
 
   args = parser.parse_args()
-  limit = args.limit
+  with profile_session(args, "evaluation_cli"):
+    run_command(args)
+
+
+def run_command(args: argparse.Namespace) -> None:
+  limits = args.limit
 
   # Evaluation logic
   with open(GOLDEN_DATASET_FILEPATH) as file:
     test_cases: list[dict] = json.load(file)["test_cases"]
-  
-  test_precisions = []
+
   movies = load_movies()["movies"]
   hybrid_search = HybridSearch(movies)
-  for tc in test_cases:
-    print(f"Next test query: {tc['query']}")
-    results = hybrid_search.rrf_search(tc['query'], 60, limit)
-    relevant_found = 0
-    for r in results:
-      if r['doc']['title'] in tc['relevant_docs']:
-        relevant_found += 1
-    precision = relevant_found / len(results)
-    recall = relevant_found / len(tc['relevant_docs'])
-    f1 = 2 * (precision * recall) / (precision + recall)
-    test_precisions.append({
-      "query": tc['query'],
-      "precision": precision,
-      "recall": recall,
-      "f1": f1,
-      "retrieved": ", ".join([ r['doc']['title'] for r in results]),
-      "relevant": tc["relevant_docs"]
-    })
-    print("-"*60)
-
-  print(f"k={limit}")
-  for t in test_precisions:
-    print(f"""
+  report, candidates = evaluate_grid(hybrid_search, test_cases, args.k, args.alpha, limits, args.workers)
+
+  # A single setting keeps the detailed per-query report
+  if len(report) == 1:
+    run = report[0]
+    limit = run["limit"]
+    print(f"k={limit}")
+    for t in run["queries"]:
+      print(f"""
 - Query: {t['query']}
 \tPrecision@{limit}: {t['precision']:.4f}
 \tRecall@{limit}: {t['recall']:.4f}
 \tF1 Score: {t['f1']:.4f}
+\tMRR: {t['mrr']:.4f}
+\tnDCG@{limit}: {t['ndcg']:.4f}
+\tLatency: {t['latency_ms']:.1f} ms
 \tRetrieved: {t['retrieved']}
 \tRelevant: {t['relevant']}""")
-    
+
+  retrieval_ms = sorted(c["retrieval_ms"] for c in candidates)
+  print(f"\nRetrieval: {len(candidates)} queries, mean {sum(retrieval_ms) / len(retrieval_ms):.1f} ms, max {retrieval_ms[-1]:.1f} ms per query")
+  print(f"{'method':<9} {'param':>6} {'limit':>5} {'P':>7} {'R':>7} {'F1':>7} {'MRR':>7} {'nDCG':>7} {'ms/q':>8} {'fuse ms':>8}")
+  for run in report:
+    print(f"{run['method']:<9} {run['param']:>6g} {run['limit']:>5} {run['precision']:>7.4f} {run['recall']:>7.4f} {run['f1']:>7.4f} {run['mrr']:>7.4f} {run['ndcg']:>7.4f} {run['latency_ms']:>8.1f} {run['fusion_ms']:>8.2f}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,15 +1,64 @@
 import argparse
-from lib.hybrid_search import normalize_values, HybridSearch, rrf_search_individual, rrf_search_batch, rrf_search_cross_encoder
+from lib.hybrid_search import normalize_values, HybridSearch, rrf_search_reranked
+from lib.sharded_search import ShardedSearch
+from lib.snapshots import build_snapshot, current_snapshot, list_snapshots, read_manifest, verify_snapshot, resolve_cache_dir, SnapshotManager
+from lib.spelling import load_or_build_spelling
+from lib.query_cache import SemanticQueryCache
+from lib.query_budget import QueryBudget
+from search_utils import QUERY_CACHE_SIZE, QUERY_CACHE_THRESHOLD, SNAPSHOT_POLL_SECONDS, CHUNKERS, DEFAULT_CHUNKER, CHUNK_TOKEN_OVERLAP
 from data_handling import load_movies
 from sentence_transformers.cross_encoder import CrossEncoder
 from lib.gemini import enhance_rewrite_query, enhance_spell_query, enhance_expand_query
 from lib.logging import rrf_results_log
+from lib.profiling import add_profile_arguments, profile_session
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from tqdm import tqdm
+import sys
+
+
+QUERY_ENHANCERS = {
+  "spell": enhance_spell_query,
+  "rewrite": enhance_rewrite_query,
+  "expand": enhance_expand_query,
+  # Offline, from the spelling dictionary of the served cache
+  "local-spell": lambda query: load_or_build_spelling(resolve_cache_dir()).correct_query(query),
+}
+
+
+def check_shard_options(args: argparse.Namespace, parser: argparse.ArgumentParser):
+  # Shard workers run plain full-vector retrieval without timeouts or expansion
+  if args.shards <= 1:
+    return
+  unsupported: list[str] = []
+  if args.retriever_timeout is not None:
+    unsupported.append("--retriever-timeout")
+  if args.reduced_dims is not None:
+    unsupported.append("--reduced-dims")
+  if getattr(args, "enhance", None) == "local-expand":
+    unsupported.append("--enhance local-expand")
+  if getattr(args, "query_cache", False):
+    unsupported.append("--query-cache")
+  if unsupported:
+    parser.error(f"{', '.join(unsupported)} cannot be combined with --shards")
+
+def create_search(movies: list[dict], args) -> HybridSearch | ShardedSearch:
+  if args.shards > 1:
+    return ShardedSearch(movies, args.shards)
+  local_expansion = getattr(args, "enhance", None) == "local-expand"
+  query_cache = SemanticQueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_THRESHOLD) if getattr(args, "query_cache", False) else None
+  return HybridSearch(movies, retriever_timeout=args.retriever_timeout, reduced_dims=args.reduced_dims, local_expansion=local_expansion, query_cache=query_cache)
+
+
+def print_budget_report(budget: QueryBudget | None):
+  if budget is None:
+    return
+  print(f"Budget: {budget.elapsed():.2f}s of {budget.seconds:.2f}s used, degradations: {'; '.join(budget.degradations) or 'none'}")
 
 
 def main() -> None:
   parser = argparse.ArgumentParser(description="Hybrid Search CLI")
+  add_profile_arguments(parser)
   subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
   # Normalize command
@@ -21,18 +70,56 @@ def main() -> None:
   weighted_search_parser.add_argument("query", type=str, help="text to initiate the search with")
   weighted_search_parser.add_argument("--alpha", type=float, nargs="?", default=0.5, help="Adjust the weight of bm25 and semantic scores. 0.0: Full weight on bm25 - 1.0: Full weight on semantic")
   weighted_search_parser.add_argument("--limit", type=int, nargs="?", default=5, help="Limits the number of results. Defaults to 5.")
+  weighted_search_parser.add_argument("--shards", type=int, default=1, help="Partition the corpus into this many shards searched by worker processes")
+  weighted_search_parser.add_argument("--retriever-timeout", type=float, help="Seconds each retriever may take before the search continues with the other one's results only")
+  weighted_search_parser.add_argument("--reduced-dims", type=int, help="Semantic first stage on a PCA projection with this many dimensions, rescored with full vectors")
+  weighted_search_parser.add_argument("--budget", type=float, help="Seconds allowed for the search; retrieval depth and effort shrink to fit and the degradations are reported")
 
   # rrf_search command
   rrf_search_parser = subparsers.add_parser("rrf-search", help="perform an rrf-search")
   rrf_search_parser.add_argument("query", type=str, help="text to initiate the search with")
   rrf_search_parser.add_argument("--k", type=int, nargs="?", default=50, help="The k parameter (a constant) controls the weight between higher-ranked results and lower-ranked ones. Defaults to 50. Suggested range: 20-100")
   rrf_search_parser.add_argument("--limit", type=int, nargs="?", default=5, help="Limits the number of results. Defaults to 5.")
-  rrf_search_parser.add_argument("--enhance", type=str, choices=["spell", "rewrite", "expand"], help="Query enhancement method")
+  rrf_search_parser.add_argument("--enhance", type=str, choices=list(QUERY_ENHANCERS) + ["local-expand"], help="Query enhancement method. local-expand adds weighted BM25 terms from the precomputed expansion table")
+  rrf_search_parser.add_argument("--speculative", action="store_true", help="Load engines and search the original query while the LLM enhances it")
   rrf_search_parser.add_argument("--rerank-method", type=str, choices=["individual", "batch", "cross_encoder"], help="perform reranking after search.")
   rrf_search_parser.add_argument("--evaluate", type=str, help="Use LLM to evaluate the relevance of results")
+  rrf_search_parser.add_argument("--shards", type=int, default=1, help="Partition the corpus into this many shards searched by worker processes")
+  rrf_search_parser.add_argument("--retriever-timeout", type=float, help="Seconds each retriever may take before the search continues with the other one's results only")
+  rrf_search_parser.add_argument("--reduced-dims", type=int, help="Semantic first stage on a PCA projection with this many dimensions, rescored with full vectors")
+  rrf_search_parser.add_argument("--budget", type=float, help="Seconds allowed for retrieval and reranking; depth, semantic effort and the rerank method are cut to fit and the degradations are reported")
+  rrf_search_parser.add_argument("--query-cache", action="store_true", help=f"Serve (reranked) results of a near-duplicate earlier query, e.g. the original query of --speculative, at cosine {QUERY_CACHE_THRESHOLD}")
+
+  # cached-search command
+  cached_search_parser = subparsers.add_parser("cached-search", help="Run rrf-search over several queries through the near-duplicate query cache and report hit rates")
+  cached_search_parser.add_argument("queries", type=str, nargs="+", help="Queries, searched in order")
+  cached_search_parser.add_argument("--k", type=int, default=50, help="RRF k parameter. Defaults to 50")
+  cached_search_parser.add_argument("--limit", type=int, default=5, help="Limits the number of results. Defaults to 5.")
+  cached_search_parser.add_argument("--threshold", type=float, default=QUERY_CACHE_THRESHOLD, help=f"Cosine similarity at which a cached query counts as the same query. Defaults to {QUERY_CACHE_THRESHOLD}")
+  cached_search_parser.add_argument("--capacity", type=int, default=QUERY_CACHE_SIZE, help=f"Cached queries kept, least recently used evicted first. Defaults to {QUERY_CACHE_SIZE}")
+
+  # snapshot commands
+  snapshot_build_parser = subparsers.add_parser("snapshot-build", help="Build all caches into a new versioned snapshot and publish it atomically")
+  snapshot_build_parser.add_argument("--impacts", action="store_true", help="Precompute quantized BM25 impacts")
+  snapshot_build_parser.add_argument("--positions", action="store_true", help="Record positional postings")
+  snapshot_build_parser.add_argument("--expansions", action="store_true", help="Precompute the local query expansion table")
+  snapshot_build_parser.add_argument("--reduced-dims", type=int, nargs="+", help="Precompute PCA projections of the chunk embeddings with these dimensions")
+  snapshot_build_parser.add_argument("--chunker", type=str, choices=CHUNKERS, help=f"Chunker for the chunk embeddings. Defaults to {DEFAULT_CHUNKER}")
+  snapshot_build_parser.add_argument("--overlap-tokens", type=int, help=f"Token chunker overlap. Defaults to {CHUNK_TOKEN_OVERLAP}")
+  subparsers.add_parser("snapshot-list", help="List cache snapshots and verify their checksums")
+
+  # serve command
+  serve_parser = subparsers.add_parser("serve", help="Answer rrf-search queries read from stdin, one per line, from the published snapshot; newly published snapshots are swapped in while serving")
+  serve_parser.add_argument("--k", type=int, default=50, help="RRF k parameter. Defaults to 50")
+  serve_parser.add_argument("--limit", type=int, default=5, help="Limits the number of results. Defaults to 5.")
+  serve_parser.add_argument("--poll", type=float, default=SNAPSHOT_POLL_SECONDS, help=f"Seconds between checks for a newly published snapshot. Defaults to {SNAPSHOT_POLL_SECONDS}")
 
   args = parser.parse_args()
+  with profile_session(args, "hybrid_search_cli"):
+    run_command(args, parser)
+
 
+def run_command(args: argparse.Namespace, parser: argparse.ArgumentParser) -> None:
   match args.command:
     case "normalize":
       normalized_values = normalize_values(args.values)
@@ -40,61 +127,86 @@ def main() -> None:
         print(f"* {v:.4f}")
 
     case "weighted-search":
+      check_shard_options(args, parser)
       movies = load_movies()["movies"]
-      hybrid_search = HybridSearch(movies)
-      results = hybrid_search.weighted_search(args.query, args.alpha, args.limit)
+      hybrid_search = create_search(movies, args)
+      try:
+        budget = None if args.budget is None else QueryBudget(args.budget)
+        results = hybrid_search.weighted_search(args.query, args.alpha, args.limit, budget=budget)
+      finally:
+        hybrid_search.close()
       for i, r in enumerate(results):
         print(f"""{i+1}. {r['doc']['title']}
    Hybrid score: {r['hybrid']:.3f}
    BM25: {r['bm25']:.3f}, Semantic: {r['semantic']:.3f}
    {r['doc']['description'][:100]}
 """)
+      print_budget_report(budget)
          
     case "rrf-search":
+      check_shard_options(args, parser)
       print("Original query:", args.query)
-      match args.enhance:
-        case "spell":
-          new_query = enhance_spell_query(args.query)
-          if new_query != args.query:
-            print(f"Enhanced query ({args.enhance}): '{args.query}' -> '{new_query.strip()}'\n")
-            args.query = new_query
-        case "rewrite":
-          new_query = enhance_rewrite_query(args.query)
-          if new_query != args.query:
-            print(f"Enhanced query ({args.enhance}): '{args.query}' -> '{new_query.strip()}'\n")
-            args.query = new_query
-        case "expand":
-          new_query = enhance_expand_query(args.query)
-          if new_query != args.query:
-            print(f"Enhanced query ({args.enhance}): '{args.query}' -> '{new_query.strip()}'\n")
-            args.query = new_query
-
       movies = load_movies()["movies"]
-      hybrid_search = HybridSearch(movies)
-      match args.rerank_method:
+      # Reranking methods fuse limit * 5 candidates before reranking
+      search_limit = args.limit if args.rerank_method is None else args.limit * 5
+      hybrid_search = None
+      try:
+        if args.enhance is None:
+          hybrid_search = create_search(movies, args)
+        elif args.enhance == "local-expand":
+          # The query text is unchanged, the BM25 retriever adds the expansion terms
+          hybrid_search = create_search(movies, args)
+          print(f"Expanded query (local-expand): '{args.query}' + {hybrid_search.expander.describe(hybrid_search.expander.expand(args.query)) or 'no expansions'}\n")
+          new_query = args.query
+        elif args.speculative:
+          enhance = QUERY_ENHANCERS[args.enhance]
+          if args.enhance == "local-spell":
+            # Build a missing index here rather than alongside the engine's own build of the same files
+            enhance = load_or_build_spelling(resolve_cache_dir()).correct_query
+          with ThreadPoolExecutor(max_workers=1) as pool:
+            enhancement = pool.submit(enhance, args.query)
+            # Warm up models and caches and retrieve the original query while the LLM works
+            hybrid_search = create_search(movies, args)
+            hybrid_search.rrf_search(args.query, args.k, search_limit)
+            new_query = enhancement.result().strip()
+        else:
+          new_query = QUERY_ENHANCERS[args.enhance](args.query).strip()
+          hybrid_search = create_search(movies, args)
+        # An unchanged query reuses the speculative result from the rrf cache
+        if args.enhance is not None and new_query != args.query:
+          print(f"Enhanced query ({args.enhance}): '{args.query}' -> '{new_query}'\n")
+          args.query = new_query
+
+        # The budget covers retrieval and reranking, not engine loading or query enhancement
+        budget = None if args.budget is None else QueryBudget(args.budget)
+        results, rerank_method = rrf_search_reranked(hybrid_search, args.query, args.k, args.limit, args.rerank_method, budget)
+        if hybrid_search.cache_hit is not None:
+          cached_query, similarity = hybrid_search.cache_hit
+          print(f"Query cache hit: '{cached_query}' (cosine {similarity:.3f})\n")
+      finally:
+        if hybrid_search is not None:
+          hybrid_search.close()
+      match rerank_method:
         case "individual":
-          results = rrf_search_individual(hybrid_search, args.query, args.k, args.limit)
           for i, r in enumerate(results[:args.limit]):
+            rerank_score = f"{r['LLM_score']:.1f}/10" if "LLM_score" in r else "not reranked"
             print(f"""{i+1}. {r['doc']['title']}
-   Rerank score: {r["LLM_score"]:.1f}/10
+   Rerank score: {rerank_score}
    RRF score: {r['hybrid']:.3f}
    BM25 Rank: {r['bm25']:.0f}, Semantic Rank: {r['semantic']:.0f}
    {r['doc']['description'][:100]}...
    """)
             
         case "batch":
-          final_results = rrf_search_batch(hybrid_search, args.query, args.k, args.limit)
-          for i, r in enumerate(final_results[:args.limit]):
+          for i, r in enumerate(results[:args.limit]):
             print(f"""{i+1}. {r['doc']['title']}
-   Rerank rank: {i+1}
+   Rerank rank: {i+1}, LLM score: {r["LLM_score"]:.0f}/3
    RRF score: {r['hybrid']:.3f}
    BM25 Rank: {r['bm25']:.0f}, Semantic Rank: {r['semantic']:.0f}
    {r['doc']['description'][:100]}...
    """)
             
         case "cross_encoder":
-          print("Reranking top 25 results using cross_encoder method...")
-          results = rrf_search_cross_encoder(hybrid_search, args.query, args.k, args.limit)
           for i, r in enumerate(results[:args.limit]):
             print(f"""{i+1}. {r['doc']['title']}
    Cross Encoder Score: {r['encoder_score']:.3f}
@@ -104,7 +216,6 @@ def main() -> None:
    """)
 
         case _:
-          results = hybrid_search.rrf_search(args.query, args.k, args.limit)
           for i, r in enumerate(results):
             print(f"""{i+1}. {r['doc']['title']}
    RRF score: {r['hybrid']:.3f}
@@ -112,6 +223,52 @@ def main() -> None:
    {r['doc']['description'][:100]}...
    """)
 
+      print_budget_report(budget)
+
+    case "cached-search":
+      movies = load_movies()["movies"]
+      query_cache = SemanticQueryCache(args.capacity, args.threshold)
+      hybrid_search = HybridSearch(movies, query_cache=query_cache)
+      try:
+        for query in args.queries:
+          results = hybrid_search.rrf_search(query, args.k, args.limit)
+          if hybrid_search.cache_hit is None:
+            print(f"MISS '{query}'")
+          else:
+            cached_query, similarity = hybrid_search.cache_hit
+            print(f"HIT  '{query}' ~ '{cached_query}' (cosine {similarity:.3f})")
+          print("     " + ", ".join(r["doc"]["title"] for r in results))
+      finally:
+        hybrid_search.close()
+      stats = query_cache.stats()
+      print(f"\n{stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.1%}, {stats['entries']} cached queries")
+
+    case "snapshot-build":
+      movies = load_movies()["movies"]
+      build_snapshot(movies, impacts=args.impacts, positions=args.positions, expansions=args.expansions, reduced_dims=args.reduced_dims, chunker=args.chunker, overlap_tokens=args.overlap_tokens)
+
+    case "snapshot-list":
+      current = current_snapshot()
+      for version in list_snapshots():
+        manifest = read_manifest(version)
+        status = "ok" if verify_snapshot(version) else "CORRUPT"
+        marker = "*" if version == current else " "
+        print(f"{marker} {version} [{status}] corpus {manifest['corpus_hash'][:8]}, model {manifest['model_name']}, {manifest['parameters']}")
+
+    case "serve":
+      manager = SnapshotManager(lambda store, cache_dir: HybridSearch(store, cache_dir=cache_dir))
+      manager.poll(args.poll)
+      try:
+        for line in sys.stdin:
+          query = line.strip()
+          if query == "":
+            continue
+          with manager.acquire() as hybrid_search:
+            results = hybrid_search.rrf_search(query, args.k, args.limit)
+          print(f"'{query}': " + ", ".join(r["doc"]["title"] for r in results), flush=True)
+      finally:
+        manager.close()
+
     case _:
       parser.print_help()
 
@@ -1,30 +1,30 @@
 from lib.inverted_index import InvertedIndex
-from text_handling import process_string
+from lib.sparse_inverted_index import SparseInvertedIndex, create_inverted_index
+from text_handling import parse_phrase_query
 from search_utils import BM25_K1, BM25_B
+from lib.boolean_search import boolean_search
+from lib.spelling import load_or_build_spelling
+from lib.profiling import phase
+from text_handling import normalize_string
+from time import perf_counter
+from itertools import islice
+import math
 
-def search_command(query: str):
+def search_command(query: str, limit: int = 5):
   print(f"Searching for: {query}")
   idx = InvertedIndex()
   idx.load()
-  search_tokens = process_string(query)
-  search_result = []
-  done = False
-  for token in search_tokens:
-    if done: break
-    doc_ids = idx.get_documents(token)
-    for id in doc_ids:
-      search_result.append(idx.docmap[id])
-      if len(search_result) >= 5:
-        done = True
-        break
+  # The match iterator is lazy, so no work is done past the limit
+  with phase("query"):
+    search_result = list(islice(boolean_search(idx, query), limit))
   print("Search results:")
-  for i, movie in enumerate(search_result):
-    print(f"{i+1}: {movie['title']}")
+  for i, row in enumerate(search_result):
+    print(f"{i+1}: {idx.store.title(row)}")
 
 def tf_command(doc_id: int, term: str):
   idx = InvertedIndex()
   idx.load()
-  tf = idx.get_tf(doc_id, term)
+  tf = idx.get_tf(idx.store.row_of(doc_id), term)
   print(f"Term frequency of '{term}' in doc {doc_id}: {tf}")
 
 def idf_command(term: str):
@@ -36,7 +36,7 @@ def idf_command(term: str):
 def tfidf_command(doc_id: int, term: str):
   idx = InvertedIndex()
   idx.load()
-  tf_idf = idx.get_tfidf(doc_id, term)
+  tf_idf = idx.get_tfidf(idx.store.row_of(doc_id), term)
   print(f"TF-IDF score of '{term}' in document '{doc_id}': {tf_idf:.2f}")
 
 def bm25idf_command(term: str):
@@ -48,15 +48,46 @@ def bm25idf_command(term: str):
 def bm25tf_command(doc_id: int, term: str, k1: float = BM25_K1, b: float = BM25_B):
   idx = InvertedIndex()
   idx.load()
-  bm25tf = idx.get_bm25_tf(doc_id, term, k1)
+  bm25tf = idx.get_bm25_tf(idx.store.row_of(doc_id), term, k1, b)
   print(f"BM25 TF score of '{term}' in document '{doc_id}': {bm25tf:.2f}")
 
-def bm25search_command(query: str, limit: int):
+def bm25search_command(query: str, limit: int, k1: float = BM25_K1, b: float = BM25_B, backend: str = "dict"):
   # Load the data into cache
-  idx = InvertedIndex()
+  idx = create_inverted_index(backend)
   idx.load()
-  # initiate the search
-  bm25search_result = idx.bm25_search(query, limit)
-  for doc_id, score in bm25search_result:
-    movie = idx.docmap[doc_id]
-    print(f"({doc_id}) {movie['title']} - Score: {score:.2f}")
\ No newline at end of file
+  # initiate the search, quoted parts of the query are matched as phrases
+  free_text, phrases = parse_phrase_query(query)
+  bm25search_result = idx.bm25_search(free_text, limit, k1, b, phrases)
+  for row, score in bm25search_result:
+    print(f"({idx.store.id_of(row)}) {idx.store.title(row)} - Score: {score:.2f}")
+
+def bm25verify_command(queries: list[str], limit: int):
+  # Compare the CSR backend against exact on-the-fly dict scoring
+  reference = InvertedIndex()
+  reference.load()
+  reference.impacts = {}
+  sparse_idx = SparseInvertedIndex()
+  sparse_idx.load()
+  batch_results = sparse_idx.bm25_search_batch(queries, limit)
+  mismatches = 0
+  for query, csr_result in zip(queries, batch_results):
+    dict_result = reference.bm25_search(query, limit)
+    same_scores = all(math.isclose(d[1], c[1], rel_tol=1e-9, abs_tol=1e-9) for d, c in zip(dict_result, csr_result))
+    same_rows = [d[0] for d in dict_result] == [c[0] for c in csr_result]
+    if same_scores and same_rows:
+      print(f"OK: '{query}'")
+      continue
+    mismatches += 1
+    print(f"MISMATCH: '{query}'")
+    for (d_row, d_score), (c_row, c_score) in zip(dict_result, csr_result):
+      print(f"  dict ({reference.store.id_of(d_row)}) {d_score:.4f} | csr ({sparse_idx.store.id_of(c_row)}) {c_score:.4f}")
+  print(f"{len(queries) - mismatches}/{len(queries)} queries match")
+
+def spell_command(query: str, limit: int = 5):
+  corrector = load_or_build_spelling()
+  for word in normalize_string(query).split():
+    start = perf_counter()
+    suggestions = corrector.lookup(word, limit)
+    elapsed = (perf_counter() - start) * 1e6
+    print(f"{word} ({elapsed:.0f} us): " + (", ".join(f"{s} (distance {d}, df {df})" for s, d, df in suggestions) or "no suggestions"))
+  print(f"Corrected query: {corrector.correct_query(query)}")
\ No newline at end of file
@@ -2,18 +2,24 @@
 import argparse
 from keyword_commands import *
 from lib.inverted_index import InvertedIndex
-from search_utils import BM25_K1, BM25_B
+from lib.profiling import add_profile_arguments, profile_session
+from search_utils import BM25_K1, BM25_B, BM25_BACKENDS
 
 def main() -> None:
   parser = argparse.ArgumentParser(description="Keyword Search CLI")
+  add_profile_arguments(parser)
   subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
   # Search command
-  search_parser = subparsers.add_parser("search", help="Search movies using BM25")
-  search_parser.add_argument("query", type=str, help="Search query")
+  search_parser = subparsers.add_parser("search", help="Boolean keyword search over the inverted index")
+  search_parser.add_argument("query", type=str, help="Search query. Combine terms with AND, OR, NOT and parentheses; plain terms are OR-ed")
+  search_parser.add_argument("--limit", type=int, default=5, help="Maximum number of results (default 5)")
 
   # Build command
-  subparsers.add_parser("build", help="Build and save inverted index to disk")
+  build_parser = subparsers.add_parser("build", help="Build and save inverted index to disk")
+  build_parser.add_argument("--impacts", action="store_true", help="Precompute quantized BM25 impacts for the default k1 and b")
+  build_parser.add_argument("--positions", action="store_true", help="Record positional postings for phrase and proximity queries")
+  build_parser.add_argument("--backend", type=str, choices=BM25_BACKENDS, default="dict", help="BM25 backend to build (default dict)")
 
   # tf command
   tf_parser = subparsers.add_parser("tf", help="Get the term frequency for a document")
@@ -42,18 +48,39 @@ def main() -> None:
 
   # bm25search command
   bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
-  bm25search_parser.add_argument("query", type=str, help="Search query")
+  bm25search_parser.add_argument("query", type=str, help='Search query. Quote phrases to match them exactly ("dark knight") or within n extra words ("dark knight"~2)')
   bm25search_parser.add_argument("limit", type=int, nargs='?', default=5, help="Tunable limit for results (default 5)")
+  bm25search_parser.add_argument("--k1", type=float, default=BM25_K1, help="Tunable BM25 K1 parameter (disables precomputed impacts)")
+  bm25search_parser.add_argument("--b", type=float, default=BM25_B, help="Tunable BM25 b parameter (disables precomputed impacts)")
+  bm25search_parser.add_argument("--backend", type=str, choices=BM25_BACKENDS, default="dict", help="BM25 backend: dict postings or csr matrix (default dict)")
+
+  # bm25verify command
+  bm25verify_parser = subparsers.add_parser("bm25verify", help="Check the csr backend against dict BM25 results")
+  bm25verify_parser.add_argument("queries", type=str, nargs="+", help="Queries to compare")
+  bm25verify_parser.add_argument("--limit", type=int, default=10, help="Number of top results to compare (default 10)")
+
+  # spell command
+  spell_parser = subparsers.add_parser("spell", help="Spelling suggestions from the index vocabulary")
+  spell_parser.add_argument("query", type=str, help="Query to correct")
+  spell_parser.add_argument("--limit", type=int, default=5, help="Suggestions per word (default 5)")
 
   args = parser.parse_args()
-  
+  with profile_session(args, "keyword_search_cli"):
+    run_command(args, parser)
+
+
+def run_command(args: argparse.Namespace, parser: argparse.ArgumentParser) -> None:
   match args.command:
     case "search":
-      search_command(args.query)
+      # Malformed boolean queries are reported like bad arguments
+      try:
+        search_command(args.query, args.limit)
+      except ValueError as error:
+        parser.error(str(error))
 
     case "build":
-      InvertedIndexer = InvertedIndex()
-      InvertedIndexer.build()
+      InvertedIndexer = create_inverted_index(args.backend)
+      InvertedIndexer.build(args.impacts, args.positions)
 
     case "tf":
       tf_command(args.doc_id, args.term)
@@ -71,7 +98,17 @@ def main() -> None:
       bm25tf_command(args.doc_id, args.term, args.k1, args.b)
 
     case "bm25search":
-      bm25search_command(args.query, args.limit)
+      # As are phrase queries against an index without positions
+      try:
+        bm25search_command(args.query, args.limit, args.k1, args.b, args.backend)
+      except ValueError as error:
+        parser.error(str(error))
+
+    case "bm25verify":
+      bm25verify_command(args.queries, args.limit)
+
+    case "spell":
+      spell_command(args.query, args.limit)
 
     case _:
       parser.print_help()
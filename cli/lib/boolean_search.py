@@ -0,0 +1,155 @@
+from lib.inverted_index import InvertedIndex
+from lib.postings import gallop
+from text_handling import process_string
+from collections.abc import Iterator
+import re
+
+QUERY_TOKEN_PATTERN = re.compile(r"\(|\)|[^\s()]+")
+
+
+# Cursors walk sorted postings document-at-a-time. next_geq(target) returns the
+# first doc id >= target (or None), and targets only ever grow.
+class PostingCursor:
+  def __init__(self, postings: list[int]) -> None:
+    self.postings = postings
+    self.i = 0
+    self.cost = len(postings)
+
+  def next_geq(self, target: int) -> int | None:
+    self.i = gallop(self.postings, target, self.i)
+    if self.i == len(self.postings):
+      return None
+    return self.postings[self.i]
+
+
+class AndCursor:
+  def __init__(self, required: list, excluded: list) -> None:
+    # The cheapest cursor proposes candidates, the others gallop to them
+    self.required = sorted(required, key=lambda c: c.cost)
+    self.excluded = excluded
+    self.cost = self.required[0].cost
+
+  def next_geq(self, target: int) -> int | None:
+    doc = target
+    while True:
+      doc = self.required[0].next_geq(doc)
+      if doc is None:
+        return None
+      for cursor in self.required[1:]:
+        found = cursor.next_geq(doc)
+        if found is None:
+          return None
+        if found != doc:
+          doc = found
+          break
+      else:
+        if any(cursor.next_geq(doc) == doc for cursor in self.excluded):
+          doc += 1
+          continue
+        return doc
+
+
+class OrCursor:
+  def __init__(self, children: list) -> None:
+    self.children = children
+    self.cost = sum(c.cost for c in children)
+
+  def next_geq(self, target: int) -> int | None:
+    found = [d for d in (c.next_geq(target) for c in self.children) if d is not None]
+    return min(found) if found else None
+
+
+def parse_boolean_query(query: str):
+  # or_expr := and_expr ((OR)? and_expr)*   -- adjacent terms are OR-ed, like the plain search
+  # and_expr := not_expr ((AND)? NOT not_expr | AND not_expr)*   -- "a NOT b" reads as a AND NOT b
+  # not_expr := NOT not_expr | '(' or_expr ')' | word
+  tokens = QUERY_TOKEN_PATTERN.findall(query)
+  if len(tokens) == 0:
+    return None
+  pos = 0
+
+  def peek():
+    return tokens[pos] if pos < len(tokens) else None
+
+  def take():
+    nonlocal pos
+    pos += 1
+    return tokens[pos - 1]
+
+  def or_expr():
+    children = [and_expr()]
+    while peek() is not None and peek() != ")":
+      if peek() == "OR":
+        take()
+      children.append(and_expr())
+    children = [c for c in children if c is not None]
+    if len(children) == 0:
+      return None
+    return children[0] if len(children) == 1 else ("or", children)
+
+  def and_expr():
+    children = [not_expr()]
+    while peek() in ("AND", "NOT"):
+      if peek() == "AND":
+        take()
+      children.append(not_expr())
+    children = [c for c in children if c is not None]
+    if len(children) == 0:
+      return None
+    return children[0] if len(children) == 1 else ("and", children)
+
+  def not_expr():
+    token = peek()
+    if token is None:
+      raise ValueError("boolean query ends unexpectedly")
+    take()
+    if token == "NOT":
+      inner = not_expr()
+      return None if inner is None else ("not", inner)
+    if token == "(":
+      inner = or_expr()
+      if peek() != ")":
+        raise ValueError("boolean query has an unclosed '('")
+      take()
+      return inner
+    if token in (")", "AND", "OR"):
+      raise ValueError(f"unexpected '{token}' in boolean query")
+    # Stopwords drop out of the query
+    processed = process_string(token)
+    if len(processed) == 0:
+      return None
+    return ("term", processed[0]) if len(processed) == 1 else ("and", [("term", t) for t in processed])
+
+  tree = or_expr()
+  if peek() is not None:
+    raise ValueError(f"unexpected '{peek()}' in boolean query")
+  return tree
+
+
+def build_cursor(idx: InvertedIndex, node):
+  match node:
+    case ("term", token):
+      return PostingCursor(idx.get_documents(token))
+    case ("and", children):
+      required = [build_cursor(idx, c) for c in children if c[0] != "not"]
+      excluded = [build_cursor(idx, c[1]) for c in children if c[0] == "not"]
+      if len(required) == 0:
+        required = [PostingCursor(list(range(len(idx.store))))]
+      return AndCursor(required, excluded)
+    case ("or", children):
+      return OrCursor([build_cursor(idx, c) for c in children])
+    case ("not", inner):
+      return AndCursor([PostingCursor(list(range(len(idx.store))))], [build_cursor(idx, inner)])
+  raise ValueError(f"unknown boolean query node: {node}")
+
+
+def boolean_search(idx: InvertedIndex, query: str) -> Iterator[int]:
+  # Lazily yields matching document rows in ascending order; stop consuming to stop the work
+  tree = parse_boolean_query(query)
+  if tree is None:
+    return
+  cursor = build_cursor(idx, tree)
+  doc = cursor.next_geq(-1)
+  while doc is not None:
+    yield doc
+    doc = cursor.next_geq(doc + 1)
@@ -1,98 +1,297 @@
-from lib.semantic_search import SemanticSearch, cosine_similarity
+from lib.semantic_search import SemanticSearch
+from sentence_transformers import SentenceTransformer
+from lib.encode_pipeline import encode_unique, texts_fingerprint
+from lib.projection import load_or_fit_projection, project
+from lib.document_store import DocumentStore, as_store
+from lib.profiling import phase
 from data_handling import *
 from search_utils import *
 import numpy as np
 import regex as re
 from pathlib import Path
 from tqdm import tqdm
+from time import perf_counter
+from collections.abc import Iterator
+import json
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
 
 class ChunkedSemanticSearch(SemanticSearch):
-  def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+  def __init__(self, model_name: str = "all-MiniLM-L6-v2", cache_dir: str = CACHE_DIR, encoder_backend: str = DEFAULT_ENCODER_BACKEND, num_threads: int | None = None, reduced_dims: int | None = None, chunker: str | None = None, overlap_tokens: int | None = None):
     print("--- Initialize chunked semantic search ---")
-    super().__init__(model_name)
+    super().__init__(model_name, cache_dir, encoder_backend, num_threads)
+    if chunker is not None and chunker not in CHUNKERS:
+      raise ValueError(f"unknown chunker: {chunker}")
+    # Token chunks fill the model's input without being truncated by it.
+    # Chunker and overlap left as None follow the cache, see resolve_chunker
+    self.chunker = chunker
+    self.max_chunk_tokens = chunk_token_limit(self.model)
+    self.overlap_tokens = overlap_tokens
+    # One row per distinct chunk text; chunk_metadata["vector_rows"] maps every chunk to its row
     self.chunk_embeddings = None
-    self.chunk_metadata = None
+    self.chunk_metadata: dict[str, np.ndarray] | None = None
+    self.vector_norms = None
+    self.segment_starts = None
+    self.segment_rows = None
+    self.segment_counts = None
+    # First-stage search on a PCA projection of the chunk embeddings, see use_reduced_dims
+    self.reduced_dims = reduced_dims
+    self.projection = None
+    self.reduced_embeddings = None
+
+  def resolve_chunker(self, stored_spec: str | None):
+    # Settings the caller did not choose are those the cache was built with, or the defaults without a cache
+    stored_chunker, _, stored_overlap = stored_spec.split(":") if stored_spec is not None else (None, None, None)
+    if self.chunker is None:
+      self.chunker = stored_chunker or DEFAULT_CHUNKER
+    if self.overlap_tokens is None:
+      self.overlap_tokens = int(stored_overlap) if self.chunker == stored_chunker == "tokens" else CHUNK_TOKEN_OVERLAP
+
+  def chunker_spec(self) -> str:
+    # Recorded with the chunk metadata; a different spec means the cache is stale
+    if self.chunker == "tokens":
+      return f"tokens:{self.max_chunk_tokens}:{self.overlap_tokens}"
+    return f"sentences:{MAX_SEMANTIC_CHUNK_SIZE}:1"
+
+  def chunk_document(self, text: str) -> list[tuple[str, int | None]]:
+    # (chunk, token count) pairs; sentence chunks are measured by the encode pipeline
+    if self.chunker == "tokens":
+      return list(token_chunking(text, self.model.tokenizer, self.max_chunk_tokens, self.overlap_tokens))
+    return [(chunk, None) for chunk in semantic_chunking(text, MAX_SEMANTIC_CHUNK_SIZE, 1)]
 
-  def build_chunk_embeddings(self, documents: list[dict]):
-    self.documents = documents
+  def iter_chunks(self) -> Iterator[tuple[int, int, int, str, int | None]]:
+    # (document row, chunk index, chunks in the document, chunk, token count), document by document
+    for row in range(len(self.store)):
+      description = self.store.description(row)
+      if not description == "":
+        chunks = self.chunk_document(description)
+        for i, (chunk, tokens) in enumerate(chunks):
+          yield row, i, len(chunks), chunk, tokens
+
+  def build_chunk_embeddings(self, documents: list[dict] | DocumentStore):
+    self.resolve_chunker(None)
+    ensure_writable_cache(self.cache_dir, f"chunk embeddings for the {self.chunker_spec()} chunker are missing or do not match the documents")
+    self.store = as_store(documents)
     chunk_list: list[str] = []
-    chunk_metadata: list[dict] = []
-    for doc in documents:
-      self.document_map[doc["id"]] = doc
-      if not doc['description'] == "":
-        chunks = semantic_chunking(doc['description'], 4, 1)
-        chunk_list.extend(chunks)
-        for i in range(len(chunks)):
-          chunk_metadata.append({
-            "movie_idx": doc['id'],
-            "chunk_idx": i,
-            "total_chunks": len(chunks)
-          })
-    self.chunk_embeddings = self.model.encode(chunk_list, show_progress_bar=True)
-    self.chunk_metadata = chunk_metadata
-    Path(CACHE_DIR).mkdir(exist_ok=True)
-    with open(Path(CACHE_DIR, CHUNK_EMBEDDINGS_FILE), "wb") as file:      
-      np.save(file, self.chunk_embeddings)
-      print("Chunk embeddings written to cache.")
-    with open(Path(CACHE_DIR, CHUNK_METADATA_FILE), "w") as file:
-      json.dump({"chunks": chunk_metadata, "total_chunks": len(chunk_list)}, file, indent=2)
+    chunk_tokens: list[int | None] = []
+    movie_rows: list[int] = []
+    chunk_idx: list[int] = []
+    total_chunks: list[int] = []
+    for row, i, total, chunk, tokens in tqdm(self.iter_chunks(), "Chunking"):
+      chunk_list.append(chunk)
+      chunk_tokens.append(tokens)
+      movie_rows.append(row)
+      chunk_idx.append(i)
+      total_chunks.append(total)
+    lengths = None
+    if self.chunker == "tokens" and len(chunk_tokens) > 0:
+      # The chunker already counted tokens, the encode pipeline sorts batches by them
+      lengths = chunk_tokens
+      print(f"{len(chunk_list)} chunks of at most {self.max_chunk_tokens} tokens, mean {np.mean(lengths):.0f}")
+    self.chunk_embeddings, vector_rows = encode_unique(self.model, chunk_list, Path(self.cache_dir, CHUNK_EMBEDDINGS_FILE), lengths=lengths)
+    # Chunk metadata as parallel arrays, one entry per chunk
+    self.chunk_metadata = {
+      "vector_rows": vector_rows,
+      "movie_rows": np.array(movie_rows, dtype=np.int32),
+      "chunk_idx": np.array(chunk_idx, dtype=np.int32),
+      "total_chunks": np.array(total_chunks, dtype=np.int32),
+      "chunker": np.array(self.chunker_spec()),
+      # Identifies the embeddings for files derived from them, such as PCA projections
+      "fingerprint": np.array(f"{self.model_name}:{texts_fingerprint(chunk_list, self.chunk_embeddings.shape[1], ENCODE_BATCH_SIZE)}")
+    }
+    with open(Path(self.cache_dir, CHUNK_METADATA_FILE), "wb") as file:
+      np.savez(file, **self.chunk_metadata)
       print("Chunk metadata written to cache.")
+    self.__prepare_chunk_scoring()
     return self.chunk_embeddings
   
-  def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
-    self.documents = documents
-    for doc in documents:
-      self.document_map[doc["id"]] = doc
-    if Path(CACHE_DIR, CHUNK_EMBEDDINGS_FILE).exists() and Path(CACHE_DIR, CHUNK_METADATA_FILE).exists():
+  @phase("cache load")
+  def load_or_create_chunk_embeddings(self, documents: list[dict] | DocumentStore) -> np.ndarray:
+    self.store = as_store(documents)
+    if Path(self.cache_dir, CHUNK_EMBEDDINGS_FILE).exists() and Path(self.cache_dir, CHUNK_METADATA_FILE).exists():
       print("Chunk embeddings and metadata in cache. Loading...")
-      with open(Path(CACHE_DIR, CHUNK_EMBEDDINGS_FILE), "rb") as file:
+      with open(Path(self.cache_dir, CHUNK_EMBEDDINGS_FILE), "rb") as file:
         self.chunk_embeddings = np.load(file)
-      with open(Path(CACHE_DIR, CHUNK_METADATA_FILE), "r") as file:
-        self.chunk_metadata = json.load(file)["chunks"]
-      return self.chunk_embeddings
+      with np.load(Path(self.cache_dir, CHUNK_METADATA_FILE)) as cached:
+        self.chunk_metadata = {key: cached[key] for key in cached.files}
+      movie_rows = self.chunk_metadata["movie_rows"]
+      vector_rows = self.chunk_metadata.get("vector_rows", np.zeros(0, dtype=np.int32))
+      chunker = str(self.chunk_metadata["chunker"]) if "chunker" in self.chunk_metadata else None
+      self.resolve_chunker(chunker)
+      if chunker is None:
+        print("Chunk cache does not record its chunker. Rebuilding...")
+      elif chunker != self.chunker_spec():
+        print(f"Chunk cache was built with the {chunker} chunker, not {self.chunker_spec()}. Rebuilding...")
+      elif "fingerprint" in self.chunk_metadata and len(vector_rows) == len(movie_rows) and (len(movie_rows) == 0 or (movie_rows[-1] < len(self.store) and vector_rows.max() < len(self.chunk_embeddings))):
+        self.__prepare_chunk_scoring()
+        return self.chunk_embeddings
+      else:
+        print("Chunk cache does not match the documents. Rebuilding...")
     else:
       print("Chunk embeddings or metadata not found in cache. Building...")
-      return self.build_chunk_embeddings(documents)
+    return self.build_chunk_embeddings(self.store)
+
+  def __prepare_chunk_scoring(self):
+    # Chunks of one movie are contiguous, so each movie is a segment starting at its chunk 0
+    self.vector_norms = np.linalg.norm(self.chunk_embeddings, axis=1)
+    self.segment_starts = np.flatnonzero(self.chunk_metadata["chunk_idx"] == 0)
+    self.segment_rows = self.chunk_metadata["movie_rows"][self.segment_starts]
+    self.segment_counts = np.diff(np.append(self.segment_starts, len(self.chunk_metadata["movie_rows"])))
+    self.use_reduced_dims(self.reduced_dims)
+
+  def use_reduced_dims(self, dims: int | None):
+    # Loads, or fits and caches, the projection for the current chunk embeddings; None searches full vectors only
+    self.reduced_dims = dims
+    if dims is None:
+      self.projection, self.reduced_embeddings = None, None
+      return
+    filepath = Path(self.cache_dir, REDUCED_EMBEDDINGS_FILE.format(dims=dims))
+    self.projection, self.reduced_embeddings = load_or_fit_projection(self.chunk_embeddings, dims, filepath, str(self.chunk_metadata["fingerprint"]))
+
+  def __cosine(self, query_embedding: np.ndarray, chunk_rows: np.ndarray | None = None) -> np.ndarray:
+    # Per-chunk cosine similarity; shared texts are scored once and gathered
+    if chunk_rows is None:
+      embeddings, vector_norms, vector_rows = self.chunk_embeddings, self.vector_norms, self.chunk_metadata["vector_rows"]
+    else:
+      unique_rows, vector_rows = np.unique(self.chunk_metadata["vector_rows"][chunk_rows], return_inverse=True)
+      embeddings, vector_norms = self.chunk_embeddings[unique_rows], self.vector_norms[unique_rows]
+    norms = vector_norms * np.linalg.norm(query_embedding)
+    return np.divide(embeddings @ query_embedding, norms, out=np.zeros(len(norms), dtype=np.float64), where=norms != 0)[vector_rows]
     
-  def search_chunks(self, query: str, limit: int = 10) -> list:
+  def rank_movies(self, query: str, limit: int = 10, pooling: str = DEFAULT_CHUNK_POOLING, rescore_depth: int | None = None) -> list[tuple[int, float]]:
+    # Top (document row, unrounded score) pairs
+    return self.rank_embedding(self.generate_embedding(query), limit, pooling, rescore_depth)
+
+  def rank_embedding(self, query_embedding: np.ndarray, limit: int = 10, pooling: str = DEFAULT_CHUNK_POOLING, rescore_depth: int | None = None) -> list[tuple[int, float]]:
+    # rescore_depth movies from the reduced first stage are rescored with full vectors and at
+    # most that many are returned; by default a few times limit
+    candidates = max(limit * REDUCED_RESCORE_FACTOR, REDUCED_MIN_CANDIDATES) if rescore_depth is None else rescore_depth
+    if self.reduced_embeddings is None or candidates >= len(self.segment_starts):
+      # Cosine similarity of every chunk at once
+      movie_scores = pool_segments(self.__cosine(query_embedding), self.segment_starts, pooling)
+      segments = np.arange(len(self.segment_starts))
+    else:
+      segments = self.__reduced_candidates(query_embedding, candidates, pooling)
+      # Rescore the candidate movies with their full chunk vectors
+      counts = self.segment_counts[segments]
+      local_starts = np.cumsum(counts) - counts
+      chunk_rows = np.repeat(self.segment_starts[segments] - local_starts, counts) + np.arange(counts.sum())
+      movie_scores = pool_segments(self.__cosine(query_embedding, chunk_rows), local_starts, pooling)
+    # Stable sort keeps ties in document order
+    top = np.argsort(-movie_scores, kind="stable")[:limit]
+    return [(int(self.segment_rows[segments[i]]), float(movie_scores[i])) for i in top]
+
+  def __reduced_candidates(self, query_embedding: np.ndarray, candidates: int, pooling: str) -> np.ndarray:
+    # Approximate cosine: reduced dot product over the full norms
+    norms = self.vector_norms * np.linalg.norm(query_embedding)
+    approx = np.divide(self.reduced_embeddings @ project(query_embedding, self.projection), norms, out=np.zeros(len(norms), dtype=np.float64), where=norms != 0)
+    movie_scores = pool_segments(approx[self.chunk_metadata["vector_rows"]], self.segment_starts, pooling)
+    # Candidate segments in document order, so rescored ties keep it
+    return np.sort(np.argpartition(-movie_scores, candidates - 1)[:candidates])
+
+  @phase("query")
+  def search_rows(self, query: str, limit: int = 10, pooling: str = DEFAULT_CHUNK_POOLING, rescore_depth: int | None = None) -> list[tuple[int, float]]:
+    # Top (document row, score) pairs at display precision, the semantic side of hybrid fusion
     if self.chunk_embeddings is None or self.chunk_metadata is None:
       print("Chunk embeddings or metadata not found. Exiting...")
       return []
-    query_embedding = self.generate_embedding(query)
-    chunk_scores: list[dict] = []
-    for chunk_emb, chunk_meta in tqdm(zip(self.chunk_embeddings, self.chunk_metadata), "Calculating semantic score", len(self.chunk_embeddings)):
-      score = cosine_similarity(query_embedding, chunk_emb)
-      chunk_scores.append({
-        "chunk_idx": chunk_meta['chunk_idx'],
-        "movie_idx": chunk_meta['movie_idx'],
-        "score": score
-      })
-    movie_scores: dict[str, float] = {}
-    for c_score in chunk_scores:
-      if c_score['movie_idx'] not in movie_scores or c_score['score'] > movie_scores[c_score['movie_idx']]:
-        movie_scores[c_score['movie_idx']] = c_score['score']
-    movie_scores_sorted: list[tuple[str, float]] = sorted(movie_scores.items(), key=lambda item: item[1], reverse=True)
-    movie_scores_sorted = movie_scores_sorted[:limit]
-    final_result: list[dict] = []
-    for score in movie_scores_sorted:
-      id = score[0]
-      score = score[1]
-      doc = self.document_map[id]
-      final_result.append({
-      "id": id,
-      "title": doc["title"],
-      "document": doc["description"][:100],
+    return [(row, round(score, SCORE_PRECISION)) for row, score in self.rank_movies(query, limit, pooling, rescore_depth)]
+
+  def search_chunks(self, query: str, limit: int = 10, pooling: str = DEFAULT_CHUNK_POOLING) -> list:
+    return [self.format_result(row, score) for row, score in self.search_rows(query, limit, pooling)]
+
+  def format_result(self, row: int, score: float) -> dict:
+    return {
+      "id": self.store.id_of(row),
+      "title": self.store.title(row),
+      "document": self.store.description(row)[:100],
       "score": round(score, SCORE_PRECISION),
       "metadata": {}
-    })
-    return final_result
+    }
+
+
+def pool_segments(scores: np.ndarray, starts: np.ndarray, pooling: str = DEFAULT_CHUNK_POOLING) -> np.ndarray:
+  if len(starts) == 0:
+    return np.zeros(0, dtype=scores.dtype)
+  counts = np.diff(np.append(starts, len(scores)))
+  match pooling:
+    case "max":
+      return np.maximum.reduceat(scores, starts)
+    case "mean":
+      return np.add.reduceat(scores, starts) / counts
+    case "top2":
+      # Sort descending within each segment, then average its first two entries
+      segment_ids = np.repeat(np.arange(len(starts)), counts)
+      ranked = scores[np.lexsort((-scores, segment_ids))]
+      second = np.minimum(starts + 1, starts + counts - 1)
+      return (ranked[starts] + ranked[second]) / 2
+    case _:
+      raise ValueError(f"unknown pooling method: {pooling}")
+
+
+def chunk_token_limit(model: SentenceTransformer) -> int:
+  # Tokens left for text once the tokenizer adds its special tokens
+  return model.max_seq_length - len(model.tokenizer([""], add_special_tokens=True)["input_ids"][0])
+
+def count_tokens(tokenizer, texts: list[str]) -> list[int]:
+  if len(texts) == 0:
+    return []
+  return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
 
+def split_sentences(text: str) -> list[str]:
+  return [s.strip() for s in SENTENCE_BOUNDARY.split(text.strip()) if s.strip() != ""]
+
+def split_long_sentence(sentence: str, tokenizer, max_tokens: int) -> list[tuple[str, int]]:
+  # Word runs of at most max_tokens tokens
+  words = sentence.split()
+  pieces: list[tuple[str, int]] = []
+  piece: list[str] = []
+  size = 0
+  for word, tokens in zip(words, count_tokens(tokenizer, words)):
+    if piece and size + tokens > max_tokens:
+      pieces.append((" ".join(piece), size))
+      piece, size = [], 0
+    piece.append(word)
+    size += tokens
+  if piece:
+    pieces.append((" ".join(piece), size))
+  return pieces
+
+def token_chunking(text: str, tokenizer, max_tokens: int, overlap_tokens: int = CHUNK_TOKEN_OVERLAP) -> Iterator[tuple[str, int]]:
+  # Packs whole sentences into (chunk, token count) pairs of at most max_tokens tokens.
+  # Word-piece tokenizers split at whitespace first, so sentence counts add up.
+  # The next chunk repeats the trailing sentences worth up to overlap_tokens.
+  units: list[tuple[str, int]] = []
+  sentences = split_sentences(text)
+  for sentence, tokens in zip(sentences, count_tokens(tokenizer, sentences)):
+    if tokens <= max_tokens:
+      units.append((sentence, tokens))
+    else:
+      units.extend(split_long_sentence(sentence, tokenizer, max_tokens))
+  chunk: list[tuple[str, int]] = []
+  size = 0
+  for unit in units:
+    if chunk and size + unit[1] > max_tokens:
+      yield " ".join(u[0] for u in chunk), size
+      # Overlap only while the new unit still fits, so every chunk adds new text
+      carried: list[tuple[str, int]] = []
+      carried_size = 0
+      for u in reversed(chunk):
+        if carried_size + u[1] > overlap_tokens or carried_size + u[1] + unit[1] > max_tokens:
+          break
+        carried.insert(0, u)
+        carried_size += u[1]
+      chunk, size = carried, carried_size
+    chunk.append(unit)
+    size += unit[1]
+  if chunk:
+    yield " ".join(u[0] for u in chunk), size
 
 def semantic_chunking(text: str, max_chunk_size: int = MAX_SEMANTIC_CHUNK_SIZE, overlap: int = 0) -> list[str]:
   text = text.strip()
   if text == "":
     return []
-  sentences = re.split(r"(?<=[.!?])\s+", text)
+  sentences = SENTENCE_BOUNDARY.split(text)
   if len(sentences) == 1 and not sentences[0].endswith(("!", ".", "?")):
     return [text]
   stripped_sentences: list[str] = []
@@ -107,13 +306,43 @@ def semantic_chunking(text: str, max_chunk_size: int = MAX_SEMANTIC_CHUNK_SIZE,
     i += max_chunk_size - overlap
   return chunks
 
-def embed_chunks_command() -> np.ndarray:
+def embed_chunks_command(reduced_dims: list[int] | None = None, chunker: str | None = None, overlap_tokens: int | None = None) -> np.ndarray:
   movies = load_movies()["movies"]
-  CSS = ChunkedSemanticSearch()
-  return CSS.load_or_create_chunk_embeddings(movies)
+  CSS = ChunkedSemanticSearch(chunker=chunker, overlap_tokens=overlap_tokens)
+  embeddings = CSS.load_or_create_chunk_embeddings(movies)
+  for dims in reduced_dims or []:
+    CSS.use_reduced_dims(dims)
+  return embeddings
+
+def search_chunked_command(query: str, limit: int = 10, pooling: str = DEFAULT_CHUNK_POOLING, encoder_backend: str = DEFAULT_ENCODER_BACKEND, num_threads: int | None = None, reduced_dims: int | None = None, chunker: str | None = None, overlap_tokens: int | None = None) -> list[dict]:
+  movies = load_movies()["movies"]
+  CSS = ChunkedSemanticSearch(encoder_backend=encoder_backend, num_threads=num_threads, reduced_dims=reduced_dims, chunker=chunker, overlap_tokens=overlap_tokens)
+  CSS.load_or_create_chunk_embeddings(movies)
+  CSS.warm_up()
+  return CSS.search_chunks(query, limit, pooling)
 
-def search_chunked_command(query: str, limit: int = 10) -> list[dict]:
+def reduced_dims_report(dims_list: list[int], limit: int = 10, repeats: int = 5, pooling: str = DEFAULT_CHUNK_POOLING):
+  # recall@limit against the exact full-dimension ranking, and scoring latency per query (encoding excluded)
   movies = load_movies()["movies"]
   CSS = ChunkedSemanticSearch()
   CSS.load_or_create_chunk_embeddings(movies)
-  return CSS.search_chunks(query, limit)
\ No newline at end of file
+  with open(GOLDEN_DATASET_FILEPATH) as file:
+    queries = [tc["query"] for tc in json.load(file)["test_cases"]]
+  query_embeddings = [CSS.generate_embedding(query) for query in queries]
+  print(f"{len(queries)} golden queries, {len(CSS.chunk_metadata['movie_rows'])} chunks ({len(CSS.chunk_embeddings)} unique), {len(CSS.segment_starts)} movies, top {limit}, {repeats} runs each")
+  exact: list[set[int]] = []
+  for dims in [None] + dims_list:
+    CSS.use_reduced_dims(dims)
+    latencies: list[float] = []
+    recalls: list[float] = []
+    for i, query_embedding in enumerate(query_embeddings):
+      for _ in range(repeats):
+        start = perf_counter()
+        ranked = CSS.rank_embedding(query_embedding, limit, pooling)
+        latencies.append((perf_counter() - start) * 1000)
+      rows = {row for row, _ in ranked}
+      if dims is None:
+        exact.append(rows)
+      recalls.append(len(rows & exact[i]) / len(exact[i]) if exact[i] else 1.0)
+    label = "full" if dims is None else str(dims)
+    print(f"{label:>6} dims: recall@{limit} {np.mean(recalls):.4f}, mean {np.mean(latencies):.2f} ms, p95 {np.percentile(latencies, 95):.2f} ms per query")
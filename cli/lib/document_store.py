@@ -0,0 +1,71 @@
+from pathlib import Path
+import numpy as np
+
+
+class DocumentStore:
+  # The corpus in columnar form, addressed by dense row ids 0..n-1 in corpus order.
+  # Titles and descriptions are UTF-8 slices of one byte buffer: row r's title is
+  # buffer[offsets[2r]:offsets[2r+1]], its description runs to offsets[2r+2].
+  # Document ids translate to rows through a sorted copy of the id column.
+  def __init__(self, ids: np.ndarray, buffer: bytes, offsets: np.ndarray) -> None:
+    self.ids = np.asarray(ids, dtype=np.int64)
+    self.buffer = buffer
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.id_order = np.argsort(self.ids, kind="stable")
+    self.sorted_ids = self.ids[self.id_order]
+
+  @classmethod
+  def from_documents(cls, documents: list[dict]) -> "DocumentStore":
+    ids = np.fromiter((int(doc["id"]) for doc in documents), dtype=np.int64, count=len(documents))
+    parts: list[bytes] = []
+    offsets = np.zeros(2 * len(documents) + 1, dtype=np.int64)
+    position = 0
+    for row, doc in enumerate(documents):
+      for field, text in enumerate((doc["title"], doc["description"])):
+        encoded = text.encode()
+        parts.append(encoded)
+        position += len(encoded)
+        offsets[2 * row + field + 1] = position
+    return cls(ids, b"".join(parts), offsets)
+
+  def __len__(self) -> int:
+    return len(self.ids)
+
+  def id_of(self, row: int) -> int:
+    return int(self.ids[row])
+
+  def row_of(self, doc_id: int) -> int:
+    i = int(np.searchsorted(self.sorted_ids, doc_id))
+    if i == len(self.sorted_ids) or self.sorted_ids[i] != doc_id:
+      raise KeyError(doc_id)
+    return int(self.id_order[i])
+
+  def title(self, row: int) -> str:
+    return self.buffer[self.offsets[2 * row]:self.offsets[2 * row + 1]].decode()
+
+  def description(self, row: int) -> str:
+    return self.buffer[self.offsets[2 * row + 1]:self.offsets[2 * row + 2]].decode()
+
+  def text(self, row: int) -> str:
+    # What the keyword index tokenizes
+    return f"{self.title(row)} {self.description(row)}"
+
+  def doc(self, row: int) -> dict:
+    # A movie dict, materialized on demand for results and prompts
+    return {"id": self.id_of(row), "title": self.title(row), "description": self.description(row)}
+
+  def docs(self) -> list[dict]:
+    return [self.doc(row) for row in range(len(self))]
+
+  def save(self, filepath: str | Path):
+    with open(filepath, "wb") as file:
+      np.savez(file, ids=self.ids, offsets=self.offsets, buffer=np.frombuffer(self.buffer, dtype=np.uint8))
+
+  @classmethod
+  def load(cls, filepath: str | Path) -> "DocumentStore":
+    with np.load(filepath) as cached:
+      return cls(cached["ids"], cached["buffer"].tobytes(), cached["offsets"])
+
+
+def as_store(documents: "list[dict] | DocumentStore") -> DocumentStore:
+  return documents if isinstance(documents, DocumentStore) else DocumentStore.from_documents(documents)
@@ -0,0 +1,92 @@
+from search_utils import ENCODE_BATCH_SIZE, ENCODE_CHECKPOINT_EVERY
+from sentence_transformers import SentenceTransformer
+from pathlib import Path
+from collections.abc import Iterable
+from tqdm import tqdm
+import numpy as np, hashlib, json, os
+
+
+def token_lengths(model: SentenceTransformer, texts: list[str]) -> np.ndarray:
+  encoded = model.tokenizer(texts, add_special_tokens=True, truncation=True, max_length=model.max_seq_length)
+  return np.array([len(ids) for ids in encoded["input_ids"]], dtype=np.int64)
+
+def texts_fingerprint(texts: list[str], dimensions: int, batch_size: int) -> str:
+  digest = hashlib.sha256(f"{dimensions}:{batch_size}:{len(texts)}".encode())
+  for text in texts:
+    digest.update(text.encode())
+    digest.update(b"\0")
+  return digest.hexdigest()
+
+def encode_to_file(model: SentenceTransformer, texts: list[str], filepath: str | Path, batch_size: int = ENCODE_BATCH_SIZE, lengths: np.ndarray | None = None) -> np.ndarray:
+  # Encodes texts in batches of similar token length and streams the rows, in
+  # original order, into a memmapped .npy file. Interrupted runs resume from the
+  # last checkpoint as long as the texts are unchanged. Token lengths already
+  # measured by the caller (e.g. the token chunker) save a tokenizer pass.
+  filepath = Path(filepath)
+  filepath.parent.mkdir(parents=True, exist_ok=True)
+  partial_path = filepath.with_name(filepath.name + ".partial")
+  progress_path = filepath.with_name(filepath.name + ".progress.json")
+  dimensions = model.get_sentence_embedding_dimension()
+  fingerprint = texts_fingerprint(texts, dimensions, batch_size)
+
+  # Short texts batch with short texts, so batches carry little padding
+  if lengths is None and len(texts) > 0:
+    lengths = token_lengths(model, texts)
+  order = np.argsort(lengths, kind="stable") if len(texts) > 0 else np.zeros(0, dtype=np.int64)
+  batches_total = (len(texts) + batch_size - 1) // batch_size
+
+  batches_done = 0
+  if progress_path.exists() and partial_path.exists():
+    with open(progress_path) as file:
+      progress = json.load(file)
+    if progress["fingerprint"] == fingerprint:
+      batches_done = progress["batches_done"]
+      print(f"Resuming encoding at batch {batches_done}/{batches_total}")
+  if batches_done > 0:
+    output = np.lib.format.open_memmap(partial_path, mode="r+")
+  else:
+    output = np.lib.format.open_memmap(partial_path, mode="w+", dtype=np.float32, shape=(len(texts), dimensions))
+
+  def checkpoint(done: int):
+    output.flush()
+    tmp_path = progress_path.with_name(progress_path.name + ".tmp")
+    with open(tmp_path, "w") as file:
+      json.dump({"fingerprint": fingerprint, "batches_done": done}, file)
+    os.replace(tmp_path, progress_path)
+
+  for b in tqdm(range(batches_done, batches_total), "Encoding batches", batches_total, initial=batches_done):
+    rows = order[b * batch_size : (b + 1) * batch_size]
+    output[rows] = model.encode([texts[r] for r in rows], batch_size=len(rows), convert_to_numpy=True)
+    if (b + 1) % ENCODE_CHECKPOINT_EVERY == 0:
+      checkpoint(b + 1)
+
+  output.flush()
+  del output
+  os.replace(partial_path, filepath)
+  progress_path.unlink(missing_ok=True)
+  print(f"Embeddings written to {filepath}")
+  return np.load(filepath, mmap_mode="r")
+
+def deduplicate_texts(texts: Iterable[str]) -> tuple[list[str], np.ndarray]:
+  # Unique texts in first-seen order, and for every text the row of its unique copy
+  unique_rows: dict[bytes, int] = {}
+  unique_texts: list[str] = []
+  rows: list[int] = []
+  for text in texts:
+    key = hashlib.sha1(text.encode()).digest()
+    if key not in unique_rows:
+      unique_rows[key] = len(unique_texts)
+      unique_texts.append(text)
+    rows.append(unique_rows[key])
+  return unique_texts, np.array(rows, dtype=np.int32)
+
+def encode_unique(model: SentenceTransformer, texts: Iterable[str], filepath: str | Path, batch_size: int = ENCODE_BATCH_SIZE, lengths: list[int] | None = None) -> tuple[np.ndarray, np.ndarray]:
+  # Encodes each distinct text once; the i-th text embeds as vectors[rows[i]]
+  unique_texts, rows = deduplicate_texts(texts)
+  if len(unique_texts) < len(rows):
+    print(f"Encoding {len(unique_texts)} unique texts for {len(rows)} inputs")
+  unique_lengths = None
+  if lengths is not None:
+    # Rows are numbered in first-seen order, so the first index of each row is that text's length
+    unique_lengths = np.asarray(lengths, dtype=np.int64)[np.unique(rows, return_index=True)[1]]
+  return encode_to_file(model, unique_texts, filepath, batch_size, unique_lengths), rows
@@ -0,0 +1,50 @@
+from sentence_transformers import SentenceTransformer
+from data_handling import GOLDEN_DATASET_FILEPATH
+from time import perf_counter
+import numpy as np, copy, json, torch
+
+
+def configure_threads(num_threads: int | None):
+  # Intra-op threads used by the CPU matmuls of one forward pass
+  if num_threads is not None:
+    torch.set_num_threads(num_threads)
+
+def create_query_encoder(model: SentenceTransformer, backend: str = "float32") -> SentenceTransformer:
+  match backend:
+    case "float32":
+      return model
+    case "int8":
+      # Dynamic quantization: int8 weights for every Linear layer, activations quantized on the fly (CPU only)
+      cpu_model = copy.deepcopy(model).to("cpu")
+      return torch.ao.quantization.quantize_dynamic(cpu_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    case _:
+      raise ValueError(f"unknown encoder backend: {backend}")
+
+def warm_up(model: SentenceTransformer):
+  # The first forward pass pays for lazy initialization, keep it off the first query
+  model.encode(["warm-up query"])
+
+def encoder_report(model_name: str = "all-MiniLM-L6-v2", num_threads: int | None = None, repeats: int = 5):
+  configure_threads(num_threads)
+  with open(GOLDEN_DATASET_FILEPATH) as file:
+    queries = [tc["query"] for tc in json.load(file)["test_cases"]]
+  reference = SentenceTransformer(model_name, device="cpu")
+  encoders = {"float32": reference, "int8": create_query_encoder(reference, "int8")}
+  embeddings: dict[str, np.ndarray] = {}
+  latencies: dict[str, list[float]] = {}
+  for backend, model in encoders.items():
+    warm_up(model)
+    latencies[backend] = []
+    for query in queries:
+      for _ in range(repeats):
+        start = perf_counter()
+        model.encode([query])
+        latencies[backend].append((perf_counter() - start) * 1000)
+    embeddings[backend] = model.encode(queries)
+  fp32, int8 = embeddings["float32"], embeddings["int8"]
+  cosines = np.sum(fp32 * int8, axis=1) / (np.linalg.norm(fp32, axis=1) * np.linalg.norm(int8, axis=1))
+  print(f"{len(queries)} golden queries, {repeats} runs each, {torch.get_num_threads()} threads")
+  print(f"Cosine drift vs float32: mean {np.mean(1 - cosines):.5f}, max {np.max(1 - cosines):.5f}, min cosine {np.min(cosines):.5f}")
+  for backend, times in latencies.items():
+    print(f"{backend:>8}: mean {np.mean(times):.2f} ms, p50 {np.median(times):.2f} ms, p95 {np.percentile(times, 95):.2f} ms per query")
+  print(f"int8 speedup (p50): {np.median(latencies['float32']) / np.median(latencies['int8']):.2f}x")
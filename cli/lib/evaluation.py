@@ -0,0 +1,95 @@
+from lib.hybrid_search import HybridSearch, fuse_rrf, fuse_weighted
+from lib.document_store import DocumentStore
+from lib.profiling import phase
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import math
+
+
+def precision_at_k(retrieved: list[str], relevant: list[str]) -> float:
+  if len(retrieved) == 0:
+    return 0.0
+  return sum(1 for title in retrieved if title in relevant) / len(retrieved)
+
+def recall_at_k(retrieved: list[str], relevant: list[str]) -> float:
+  if len(relevant) == 0:
+    return 0.0
+  return sum(1 for title in retrieved if title in relevant) / len(relevant)
+
+def f1_score(precision: float, recall: float) -> float:
+  if precision + recall == 0:
+    return 0.0
+  return 2 * (precision * recall) / (precision + recall)
+
+def reciprocal_rank(retrieved: list[str], relevant: list[str]) -> float:
+  for i, title in enumerate(retrieved):
+    if title in relevant:
+      return 1 / (i + 1)
+  return 0.0
+
+def ndcg_at_k(retrieved: list[str], relevant: list[str], k: int) -> float:
+  # Binary relevance
+  dcg = sum(1 / math.log2(i + 2) for i, title in enumerate(retrieved[:k]) if title in relevant)
+  ideal = sum(1 / math.log2(i + 2) for i in range(min(len(relevant), k)))
+  return dcg / ideal if ideal > 0 else 0.0
+
+
+def retrieve_candidates(hybrid_search: HybridSearch, test_cases: list[dict], depth: int, workers: int = 4) -> list[dict]:
+  # One BM25 + semantic retrieval per golden query, queries in parallel. The
+  # retrievers run side by side, so a query's retrieval takes as long as the
+  # slower one's own work; time spent queued behind other queries is left out.
+  def retrieve(tc: dict) -> dict:
+    timings: dict[str, float] = {}
+    bm25_results, semantic_results, _ = hybrid_search.retrieve(tc["query"], depth, timings=timings)
+    return {
+      "query": tc["query"],
+      "relevant": tc["relevant_docs"],
+      "bm25": bm25_results,
+      "semantic": semantic_results,
+      "retrieval_ms": max(timings.values()) * 1000
+    }
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    return list(pool.map(retrieve, test_cases))
+
+def fuse_candidates(candidates: dict, store: DocumentStore, method: str, param: float, limit: int) -> list[dict]:
+  # Same candidate depth as HybridSearch uses for this limit, so results match a live search
+  depth = limit * 500
+  bm25_results = candidates["bm25"][:depth]
+  semantic_results = candidates["semantic"][:depth]
+  if method == "rrf":
+    return fuse_rrf([ x[0] for x in bm25_results ], [ x[0] for x in semantic_results ], store, int(param), limit)
+  return fuse_weighted(bm25_results, semantic_results, store, param, limit)
+
+@phase("query")
+def evaluate_grid(hybrid_search: HybridSearch, test_cases: list[dict], k_values: list[int], alpha_values: list[float], limits: list[int], workers: int = 4) -> tuple[list[dict], list[dict]]:
+  # Retrieve once at the deepest candidate depth, then re-fuse in memory for every setting
+  candidates = retrieve_candidates(hybrid_search, test_cases, max(limits) * 500, workers)
+  settings = [("rrf", k) for k in k_values] + [("weighted", alpha) for alpha in alpha_values]
+  report: list[dict] = []
+  for method, param in settings:
+    for limit in limits:
+      per_query: list[dict] = []
+      for c in candidates:
+        start = perf_counter()
+        results = fuse_candidates(c, hybrid_search.store, method, param, limit)
+        fusion_ms = (perf_counter() - start) * 1000
+        retrieved = [ r["doc"]["title"] for r in results ]
+        precision = precision_at_k(retrieved, c["relevant"])
+        recall = recall_at_k(retrieved, c["relevant"])
+        per_query.append({
+          "query": c["query"],
+          "precision": precision,
+          "recall": recall,
+          "f1": f1_score(precision, recall),
+          "mrr": reciprocal_rank(retrieved, c["relevant"]),
+          "ndcg": ndcg_at_k(retrieved, c["relevant"], limit),
+          "latency_ms": c["retrieval_ms"] + fusion_ms,
+          "fusion_ms": fusion_ms,
+          "retrieved": ", ".join(retrieved),
+          "relevant": c["relevant"]
+        })
+      summary = {"method": method, "param": param, "limit": limit, "queries": per_query}
+      for metric in ("precision", "recall", "f1", "mrr", "ndcg", "latency_ms", "fusion_ms"):
+        summary[metric] = sum(q[metric] for q in per_query) / len(per_query) if per_query else 0.0
+      report.append(summary)
+  return report, candidates
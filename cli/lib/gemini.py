@@ -1,6 +1,85 @@
-import os
+import os, re, json, math
 from dotenv import load_dotenv
 from google import genai
+from concurrent.futures import ThreadPoolExecutor
+from search_utils import LLM_PROMPT_TOKEN_BUDGET, LLM_DESCRIPTION_TOKENS, LLM_RERANK_WORKERS
+
+# Rough token count for prompt budgeting, Gemini averages about four characters per token
+CHARS_PER_TOKEN = 4
+# Instructions and query text of the batch rerank prompt, reserved out of the budget
+RERANK_PROMPT_OVERHEAD_TOKENS = 200
+
+def estimate_tokens(text: str) -> int:
+  return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def compact_description(description: str, max_tokens: int = LLM_DESCRIPTION_TOKENS) -> str:
+  # Keep the leading sentences that fit, movie descriptions front-load the premise
+  max_chars = max_tokens * CHARS_PER_TOKEN
+  if len(description) <= max_chars:
+    return description
+  summary = ""
+  for sentence in re.split(r"(?<=[.!?])\s+", description):
+    if len(summary) + len(sentence) + 1 > max_chars:
+      break
+    summary = f"{summary} {sentence}".strip()
+  if summary:
+    return summary
+  # A single long sentence is cut at a word boundary
+  return description[:max_chars].rsplit(" ", 1)[0] + "..."
+
+def format_candidate(i: int, doc: dict, description_tokens: int = LLM_DESCRIPTION_TOKENS) -> str:
+  return f"{i}. {doc.get('title', '')}: {compact_description(doc.get('description', ''), description_tokens)}"
+
+def build_candidate_batches(docs: list[dict], token_budget: int = LLM_PROMPT_TOKEN_BUDGET, description_tokens: int = LLM_DESCRIPTION_TOKENS) -> list[list[str]]:
+  # Packs candidates in rank order into prompts that each fit the token budget; ids restart at 0 per batch
+  available = max(token_budget - RERANK_PROMPT_OVERHEAD_TOKENS, 1)
+  batches: list[list[str]] = []
+  batch: list[str] = []
+  used = 0
+  for doc in docs:
+    line = format_candidate(len(batch), doc, description_tokens)
+    tokens = estimate_tokens(line) + 1
+    if batch and used + tokens > available:
+      batches.append(batch)
+      batch, used = [], 0
+      line = format_candidate(0, doc, description_tokens)
+      tokens = estimate_tokens(line) + 1
+    batch.append(line)
+    used += tokens
+  if batch:
+    batches.append(batch)
+  return batches
+
+def parse_score(text: str | None, low: float = 0, high: float = 10) -> float | None:
+  # An empty response is no score, not a cue to parse something else such as the query
+  if not text:
+    return None
+  match = re.search(r"-?\d+(?:\.\d+)?", text)
+  if match is None:
+    return None
+  return min(max(float(match.group()), low), high)
+
+def parse_score_list(text: str | None, expected: int, low: float = 0, high: float = 3) -> list[float]:
+  # Tolerates code fences, surrounding prose and wrong lengths; missing or invalid scores count as the lowest
+  values: list = []
+  # A truncated response may lack the closing bracket
+  match = re.search(r"\[[^\[\]]*\]?", text) if text else None
+  if match is not None:
+    try:
+      values = json.loads(match.group())
+    except json.JSONDecodeError:
+      values = re.findall(r"-?\d+(?:\.\d+)?", match.group())
+  if not isinstance(values, list):
+    values = []
+  scores: list[float] = []
+  for value in values[:expected]:
+    try:
+      scores.append(min(max(float(value), low), high))
+    except (TypeError, ValueError):
+      scores.append(float(low))
+  if len(values) != expected:
+    print(f"LLM returned {len(values)} scores for {expected} results")
+  return scores + [float(low)] * (expected - len(scores))
 
 def enhance_spell_query(query: str):
   load_dotenv()
@@ -75,7 +154,7 @@ Query: "{query}"
   else:
     return query
   
-def rerank_individual(query: str, doc: dict):
+def rerank_individual(query: str, doc: dict) -> str | None:
   load_dotenv()
   api_key = os.environ.get("GEMINI_API_KEY")
   client = genai.Client(api_key=api_key)
@@ -83,7 +162,7 @@ def rerank_individual(query: str, doc: dict):
   res = client.models.generate_content(model="gemini-2.0-flash-001", contents=f"""Rate how well this movie matches the search query.
 
 Query: "{query}"
-Movie: {doc.get("title", "")} - {doc.get("document", "")}
+Movie: {doc.get("title", "")} - {compact_description(doc.get("description", ""))}
 
 Consider:
 - Direct relevance to query
@@ -95,10 +174,7 @@ Give me ONLY the number in your response, no other text or explanation.
 
 Score:""")
 
-  if res.text:
-    return res.text
-  else:
-    return query
+  return res.text
   
 def LLM_Evaluate_results(query: str, doc_list_str: str):
   load_dotenv()
@@ -122,7 +198,7 @@ Return ONLY the IDs in order of relevance (best match first). Return a valid JSO
   else:
     return query
 
-def rerank_batch(query: str, doc_list_str: str):
+def rerank_batch(query: str, doc_list_str: str) -> str | None:
   load_dotenv()
   api_key = os.environ.get("GEMINI_API_KEY")
   client = genai.Client(api_key=api_key)
@@ -146,7 +222,14 @@ Return ONLY the scores in the same order you were given the documents. Return a
 
 [2, 0, 3, 2, 0, 1]""")
 
-  if res.text:
-    return res.text
-  else:
-    return query
\ No newline at end of file
+  return res.text
+
+def rerank_batch_scores(query: str, docs: list[dict], token_budget: int = LLM_PROMPT_TOKEN_BUDGET, workers: int = LLM_RERANK_WORKERS) -> list[float]:
+  # Sub-batches are scored in parallel and merged back in candidate order
+  batches = build_candidate_batches(docs, token_budget)
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    responses = list(pool.map(lambda batch: rerank_batch(query, "\n".join(batch)), batches))
+  scores: list[float] = []
+  for batch, response in zip(batches, responses):
+    scores.extend(parse_score_list(response, len(batch)))
+  return scores
@@ -1,78 +1,210 @@
 from lib.logging import rrf_results_log
 from lib.inverted_index import InvertedIndex
+from lib.document_store import DocumentStore
+from lib.sparse_inverted_index import create_inverted_index
 from lib.chunked_semantic_search import ChunkedSemanticSearch
-from lib.gemini import LLM_Evaluate_results, rerank_batch, rerank_individual
+from lib.snapshots import resolve_cache_dir, cache_version, check_snapshot_corpus
+from lib.query_cache import SemanticQueryCache
+from lib.query_budget import QueryBudget, plan_depth, record_stage, record_retrieval, estimate_stage
+from lib.query_expansion import load_or_build_expansions
+from lib.profiling import phase
+from lib.gemini import LLM_Evaluate_results, rerank_individual, rerank_batch_scores, parse_score
 from sentence_transformers.cross_encoder import CrossEncoder
 from tqdm import tqdm
-from time import sleep
-import json
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from time import sleep, monotonic
+from collections import OrderedDict
+from collections.abc import Callable
+from search_utils import FUSED_RESULT_CACHE_SIZE, RETRIEVER_WORKERS, DEFAULT_CHUNK_POOLING, HYBRID_RESCORE_DEPTH, BUDGET_RESCORE_DEPTH, RERANK_FALLBACKS
+
+
+def timed(timings: dict[str, float], name: str, search: Callable, *args):
+  start = monotonic()
+  results = search(*args)
+  timings[name] = monotonic() - start
+  return results
 
 
 class HybridSearch:
-  def __init__(self, documents):
-    self.documents = documents
-    self.semantic_search = ChunkedSemanticSearch()
-    self.semantic_search.load_or_create_chunk_embeddings(documents)
-    self.idx = InvertedIndex()
-    self.idx.build()
+  def __init__(self, documents, bm25_backend: str = "dict", retriever_timeout: float | None = None, cache_dir: str | None = None, reduced_dims: int | None = None, local_expansion: bool = False, query_cache: SemanticQueryCache | None = None):
+    # Defaults to the published cache snapshot, if any
+    self.cache_dir = resolve_cache_dir() if cache_dir is None else cache_dir
+    check_snapshot_corpus(self.cache_dir, documents)
+    self.idx = create_inverted_index(bm25_backend, self.cache_dir)
+    self.idx.build(documents=documents)
+    # One copy of the corpus: both retrievers and the fusion address documents by row
+    self.store: DocumentStore = self.idx.store
+    self.semantic_search = ChunkedSemanticSearch(cache_dir=self.cache_dir, reduced_dims=reduced_dims)
+    self.semantic_search.load_or_create_chunk_embeddings(self.store)
+    self.semantic_search.warm_up()
+    # Weighted BM25 expansion terms from the precomputed table, see --enhance local-expand
+    self.expander = load_or_build_expansions(self.idx, self.semantic_search.model, self.cache_dir) if local_expansion else None
+    # BM25 and the semantic side run side by side; the encoder forward pass and NumPy scoring release the GIL.
+    # Threads start on demand, so retrievers still running past their deadline do not hold up later queries
+    self.executor = ThreadPoolExecutor(max_workers=RETRIEVER_WORKERS, thread_name_prefix="retriever")
+    self.retriever_timeout = retriever_timeout
+    # Recent fused rrf results, so a speculative search for the same query is not repeated
+    self.rrf_cache: OrderedDict[tuple[str, int, int], list[dict]] = OrderedDict()
+    # Optional cache of results for near-duplicate queries, may be shared with other engines
+    self.query_cache = query_cache
+    self.index_version = cache_version(self.cache_dir)
+    # The cached query and similarity when the last cached() call was a hit
+    self.cache_hit: tuple[str, float] | None = None
 
   def _bm25_search(self, query, limit):
-    self.idx.load()
-    return self.idx.bm25_search(query, limit)
-
-  def weighted_search(self, query, alpha, limit=5) -> list[dict]:
-    bm25_results = self._bm25_search(query, limit * 500)
-    semantic_results = self.semantic_search.search_chunks(query, limit * 500)
-    # normalize bm25 scores
-    normalized_bm25 = list(zip( [int(x[0]) for x in bm25_results], normalize_values([x[1] for x in bm25_results ])))
-    # normalize semantic scores
-    normalized_semantic = list(zip( [ int(x["id"]) for x in semantic_results ], normalize_values([x["score"] for x in semantic_results]) ))
-    # Combine results
-    results: dict[int, dict] = {}
-    for doc_id, bm25_score in normalized_bm25:
-      if doc_id not in results:
-        results[doc_id] = {}
-      results[doc_id]["bm25"] = bm25_score
-      results[doc_id]["doc"] = self.idx.docmap[doc_id]
-      semantic_score = results[doc_id].get("semantic", 0)
-      results[doc_id]["hybrid"] = compute_hybrid_score(bm25_score, semantic_score, alpha)
-    for doc_id, semantic_score in normalized_semantic:
-      if doc_id not in results:
-        results[doc_id] = {}
-      results[doc_id]["semantic"] = semantic_score
-      bm25_score = results[doc_id].get("bm25", 0)
-      results[doc_id]["hybrid"] = compute_hybrid_score(bm25_score, semantic_score, alpha)
-
-    return sorted(results.values(), key=lambda item: item["hybrid"], reverse=True)[:limit]
+    if self.expander is None:
+      return self.idx.bm25_search(query, limit)
+    return self.idx.bm25_search(query, limit, expansions=self.expander.expand(query))
+
+  def retrieve(self, query, limit, budget: QueryBudget | None = None, rescore_depth: int = HYBRID_RESCORE_DEPTH, timings: dict[str, float] | None = None) -> tuple[list[tuple[int, float]], list[tuple[int, float]], list[str]]:
+    # (row, score) pairs from each retriever, and the retrievers dropped at the deadline.
+    # timings receives the seconds each finished retriever spent working, not waiting for a thread
+    timings = {} if timings is None else timings
+    bm25_future = self.executor.submit(timed, timings, "bm25", self._bm25_search, query, limit)
+    semantic_future = self.executor.submit(timed, timings, "semantic", self.semantic_search.search_rows, query, limit, DEFAULT_CHUNK_POOLING, rescore_depth)
+    deadline = None if self.retriever_timeout is None else monotonic() + self.retriever_timeout
+    if budget is not None:
+      # Retrieval gets what the later stages have not reserved
+      budget_deadline = monotonic() + budget.available()
+      deadline = budget_deadline if deadline is None else min(deadline, budget_deadline)
+    degraded: list[str] = []
+    bm25_results = self.__collect(bm25_future, deadline, "bm25", degraded)
+    semantic_results = self.__collect(semantic_future, deadline, "semantic", degraded)
+    if budget is not None:
+      for retriever in degraded:
+        budget.degrade(f"{retriever} results dropped at the deadline")
+    return bm25_results, semantic_results, degraded
+
+  def _plan(self, limit: int, budget: QueryBudget | None) -> tuple[int, int]:
+    # Candidate depth and movies rescored with full vectors that fit the budget
+    depth = plan_depth(limit * 500, limit, budget)
+    if depth == limit * 500 or self.semantic_search.reduced_embeddings is None:
+      return depth, HYBRID_RESCORE_DEPTH
+    budget.degrade(f"semantic rescoring of {BUDGET_RESCORE_DEPTH} instead of {HYBRID_RESCORE_DEPTH} candidates")
+    return depth, BUDGET_RESCORE_DEPTH
+
+  def __fused(self, query, limit, budget: QueryBudget | None, fuse: Callable[[list, list], list[dict]]) -> tuple[list[dict], list[str]]:
+    # Fused results and how this call degraded: dropped retrievers, "depth"
+    start = monotonic()
+    depth, rescore_depth = self._plan(limit, budget)
+    bm25_results, semantic_results, degraded = self.retrieve(query, depth, budget, rescore_depth)
+    fused = fuse(bm25_results, semantic_results)
+    record_retrieval(depth, limit * 500, degraded, start)
+    return fused, degraded
+
+  def __collect(self, future: Future, deadline: float | None, retriever: str, degraded: list[str]) -> list:
+    timeout = None if deadline is None else max(0.0, deadline - monotonic())
+    try:
+      return future.result(timeout)
+    except FutureTimeoutError:
+      # The late search finishes in the background on its own thread, its result is dropped
+      future.cancel()
+      degraded.append(retriever)
+      print(f"{retriever} retrieval missed its deadline, continuing without it")
+      return []
+
+  def cached(self, query: str, key: tuple, search: Callable[[], tuple[list[dict], list[str]]]) -> tuple[list[dict], list[str]]:
+    # Results of a near-duplicate earlier query with the same parameters, or of search(), with their degradations
+    self.cache_hit = None
+    if self.query_cache is None:
+      return search()
+    embedding = self.semantic_search.generate_embedding(query)
+    hit = self.query_cache.get(embedding, key, self.index_version)
+    if hit is not None:
+      cached_query, similarity, results = hit
+      self.cache_hit = (cached_query, similarity)
+      return results, []
+    results, degraded = search()
+    self.cache_hit = None
+    if len(degraded) == 0:
+      self.query_cache.put(embedding, query, key, self.index_version, results)
+    return results, degraded
+
+  @phase("query")
+  def weighted_search(self, query, alpha, limit=5, budget: QueryBudget | None = None) -> list[dict]:
+    def search() -> tuple[list[dict], list[str]]:
+      return self.__fused(query, limit, budget, lambda bm25_results, semantic_results: fuse_weighted(bm25_results, semantic_results, self.store, alpha, limit))
+    return self.cached(query, ("weighted", alpha, limit), search)[0]
 
     
-  def rrf_search(self, query, k=60, limit=10, alpha=0.5):
-    bm25_ranks = [ x[0] for x in self._bm25_search(query, limit * 500) ]
-    semantic_ranks = [ x["id"] for x in self.semantic_search.search_chunks(query, limit * 500) ]
-    # Combine results
-    results: dict[int, dict] = {}
-    for i, doc_id in enumerate(bm25_ranks):
-      if doc_id not in results:
-        results[doc_id] = {}
-      bm25_rrf = compute_rrf_score(i+1, k)
-      results[doc_id]["bm25"] = i+1
-      results[doc_id]["bm25_score"] = bm25_rrf
-      results[doc_id]["doc"] = self.idx.docmap[doc_id]
-      semantic_rrf = results[doc_id].get("semantic_score", 0)
-      results[doc_id]["hybrid"] = bm25_rrf + semantic_rrf
-    for i, doc_id in enumerate(semantic_ranks):
-      if doc_id not in results:
-        results[doc_id] = {}
-      semantic_rrf = compute_rrf_score(i+1, k)
-      results[doc_id]["semantic"] = i+1
-      results[doc_id]["semantic_score"] = semantic_rrf
-      results[doc_id]["doc"] = self.idx.docmap[doc_id]
-      bm25_rrf = results[doc_id].get("bm25_score", 0)
-      results[doc_id]["hybrid"] = bm25_rrf + semantic_rrf
-
-    return sorted(results.values(), key=lambda item: item["hybrid"], reverse=True)[:limit]
+  @phase("query")
+  def rrf_search(self, query, k=60, limit=10, alpha=0.5, budget: QueryBudget | None = None):
+    return self.cached(query, ("rrf", k, limit), lambda: self.rrf_search_uncached(query, k, limit, budget))[0]
+
+  def rrf_search_uncached(self, query, k=60, limit=10, budget: QueryBudget | None = None) -> tuple[list[dict], list[str]]:
+    # rrf_search without the near-duplicate query cache, with the degradations of this call.
+    # Rerankers call this inside their own cached(), so a query is looked up once
+    key = (query, k, limit)
+    # Exact repeats, e.g. a reranker after a speculative search of the same query
+    if key in self.rrf_cache:
+      self.rrf_cache.move_to_end(key)
+      return list(self.rrf_cache[key]), []
+    fused, degraded = self.__fused(query, limit, budget, lambda bm25_results, semantic_results: fuse_rrf([ x[0] for x in bm25_results ], [ x[0] for x in semantic_results ], self.store, k, limit))
+    # Degraded results are not worth keeping
+    if len(degraded) == 0:
+      self.rrf_cache[key] = fused
+      if len(self.rrf_cache) > FUSED_RESULT_CACHE_SIZE:
+        self.rrf_cache.popitem(last=False)
+    return list(fused), degraded
+
+  def close(self):
+    # Retrievers still running past their deadline finish on their own, nothing waits for them
+    self.executor.shutdown(wait=False, cancel_futures=True)
   
 
+def fuse_weighted(bm25_results: list[tuple[int, float]], semantic_results: list[tuple[int, float]], store: DocumentStore, alpha: float = 0.5, limit: int = 5) -> list[dict]:
+  # normalize bm25 scores
+  normalized_bm25 = list(zip( [int(x[0]) for x in bm25_results], normalize_values([x[1] for x in bm25_results ])))
+  # normalize semantic scores
+  normalized_semantic = list(zip( [int(x[0]) for x in semantic_results], normalize_values([x[1] for x in semantic_results]) ))
+  # Combine results, keyed by document row
+  results: dict[int, dict] = {}
+  for row, bm25_score in normalized_bm25:
+    if row not in results:
+      results[row] = {}
+    results[row]["bm25"] = bm25_score
+    semantic_score = results[row].setdefault("semantic", 0)
+    results[row]["hybrid"] = compute_hybrid_score(bm25_score, semantic_score, alpha)
+  for row, semantic_score in normalized_semantic:
+    if row not in results:
+      results[row] = {}
+    results[row]["semantic"] = semantic_score
+    bm25_score = results[row].setdefault("bm25", 0)
+    results[row]["hybrid"] = compute_hybrid_score(bm25_score, semantic_score, alpha)
+
+  return with_documents(sorted(results.items(), key=lambda item: item[1]["hybrid"], reverse=True)[:limit], store)
+
+def fuse_rrf(bm25_ranks: list[int], semantic_ranks: list[int], store: DocumentStore, k: int = 60, limit: int = 10) -> list[dict]:
+  # Combine results, keyed by document row
+  results: dict[int, dict] = {}
+  for i, row in enumerate(bm25_ranks):
+    if row not in results:
+      results[row] = {}
+    bm25_rrf = compute_rrf_score(i+1, k)
+    results[row]["bm25"] = i+1
+    results[row]["bm25_score"] = bm25_rrf
+    # Rank 0 means the other retriever did not return the document
+    results[row].setdefault("semantic", 0)
+    semantic_rrf = results[row].get("semantic_score", 0)
+    results[row]["hybrid"] = bm25_rrf + semantic_rrf
+  for i, row in enumerate(semantic_ranks):
+    if row not in results:
+      results[row] = {}
+    semantic_rrf = compute_rrf_score(i+1, k)
+    results[row]["semantic"] = i+1
+    results[row]["semantic_score"] = semantic_rrf
+    results[row].setdefault("bm25", 0)
+    bm25_rrf = results[row].get("bm25_score", 0)
+    results[row]["hybrid"] = bm25_rrf + semantic_rrf
+
+  return with_documents(sorted(results.items(), key=lambda item: item[1]["hybrid"], reverse=True)[:limit], store)
+
+def with_documents(ranked: list[tuple[int, dict]], store: DocumentStore) -> list[dict]:
+  # Only the returned results get a document dict
+  for row, result in ranked:
+    result["doc"] = store.doc(row)
+  return [result for _, result in ranked]
+
 def normalize_values(values: list[float]) -> list[float]:
   if values == []:
     return []
@@ -91,48 +223,99 @@ def compute_hybrid_score(bm25score: float ,semantic_score: float, alpha: float =
 def compute_rrf_score(rank, k=60):
     return 1 / (k + rank)
 
-def rrf_search_individual(hybrid_search: HybridSearch, query: str, k: int = 50, limit: int = 5):
-  results = hybrid_search.rrf_search(query, k, limit * 5)
-  rrf_results_log(results)
-  for r in tqdm(results, "LLM Reranking", len(results)):
-    doc = r["doc"]
-    try:
-      LLM_score = float(rerank_individual(query, doc))
+def rrf_search_individual(hybrid_search: HybridSearch, query: str, k: int = 50, limit: int = 5, budget: QueryBudget | None = None, candidates: int | None = None):
+  candidates = limit * 5 if candidates is None else candidates
+  def search() -> tuple[list[dict], list[str]]:
+    results, degraded = hybrid_search.rrf_search_uncached(query, k, candidates, budget)
+    rrf_results_log(results)
+    if candidates < limit * 5:
+      degraded.append("rerank")
+    reranked: list[dict] = []
+    for r in tqdm(results, "LLM Reranking", len(results)):
+      if budget is not None and budget.remaining() < estimate_stage("individual"):
+        budget.degrade(f"individual rerank stopped after {len(reranked)} of {len(results)} candidates")
+        degraded.append("rerank")
+        break
+      start = monotonic()
+      doc = r["doc"]
+      response = rerank_individual(query, doc)
+      LLM_score = parse_score(response)
+      if LLM_score is None:
+        print(f"LLM did not provide an appropriate ranking: {response}")
+        LLM_score = 0
       r["LLM_score"] = LLM_score
-    except ValueError:
-      print(f"LLM did not provide an appropriate ranking: {LLM_score}")
-      r["LLM_score"] = 0
-    sleep(3)
-  results.sort(key=lambda item: item["LLM_score"], reverse=True)
-  return results
+      reranked.append(r)
+      sleep(3)
+      record_stage("individual", monotonic() - start)
+    reranked.sort(key=lambda item: item["LLM_score"], reverse=True)
+    # Candidates the budget left unscored follow in RRF order
+    return reranked + results[len(reranked):], degraded
+  # A near-duplicate query skips retrieval and the LLM calls
+  return hybrid_search.cached(query, ("individual", k, limit), search)[0]
+
+def rrf_search_batch(hybrid_search: HybridSearch, query: str, k: int = 50, limit: int = 5, budget: QueryBudget | None = None):
+  def search() -> tuple[list[dict], list[str]]:
+    results, degraded = hybrid_search.rrf_search_uncached(query, k, limit * 5, budget)
+    rrf_results_log(results)
+    print(f"Reranking the top {limit} results using batch method...\n")
+    start = monotonic()
+    LLM_scores = rerank_batch_scores(query, [ r["doc"] for r in results ])
+    record_stage("batch", monotonic() - start)
+    print("LLM scores:", LLM_scores)
+    for r, score in zip(results, LLM_scores):
+      r["LLM_score"] = score
+    # Stable sort: equal LLM scores keep their RRF order
+    return sorted(results, key=lambda item: item["LLM_score"], reverse=True), degraded
+  return hybrid_search.cached(query, ("batch", k, limit), search)[0]
+
+def rrf_search_cross_encoder(hybrid_search: HybridSearch, query: str, k: int = 50, limit: int = 5, budget: QueryBudget | None = None):
+  def search() -> tuple[list[dict], list[str]]:
+    print("Reranking top 25 results using cross_encoder method...")
+    results, degraded = hybrid_search.rrf_search_uncached(query, k, limit * 5, budget)
+    rrf_results_log(results)
+    start = monotonic()
+    pairs: list[tuple[str, str]] = []
+    for r in results:
+      pairs.append( (query, f"{r['doc'].get('title', '')} - {r.get('doc', '')}"))
+    with phase("model load"):
+      encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
+    scores = encoder.predict(pairs)
+    for i, score in enumerate(scores):
+      results[i]['encoder_score'] = score
+    record_stage("cross_encoder", monotonic() - start)
+    return sorted(results, key=lambda item: item['encoder_score'], reverse=True), degraded
+  return hybrid_search.cached(query, ("cross_encoder", k, limit), search)[0]
+
+def plan_rerank(rerank_method: str | None, candidates: int, limit: int, budget: QueryBudget) -> tuple[str | None, int]:
+  # The requested method if its estimate fits next to retrieval, else fewer
+  # individually reranked candidates, else the next cheaper method
+  while rerank_method is not None:
+    available = budget.remaining() - estimate_stage("retrieve")
+    if estimate_stage(rerank_method, candidates) <= available:
+      return rerank_method, candidates
+    if rerank_method == "individual":
+      fit = int(available // estimate_stage("individual"))
+      if fit >= limit:
+        budget.degrade(f"individual rerank of {fit} instead of {candidates} candidates")
+        return rerank_method, fit
+    fallback = RERANK_FALLBACKS[rerank_method]
+    budget.degrade(f"{rerank_method} rerank replaced by {fallback or 'no rerank'}")
+    rerank_method = fallback
+  return None, candidates
 
-def rrf_search_batch(hybrid_search: HybridSearch, query: str, k: int = 50, limit: int = 5):
-  results = hybrid_search.rrf_search(query, k, limit * 5)
-  rrf_results_log(results)
-  doc_list_str = ""
-  for i, r in enumerate(results):
-    doc_list_str += f"""Title: {r['doc']['title']}
-ID: {i}
-Description: {r['doc']['description']}
--------------------------------------------------------"""
-  print(f"Reranking the top {limit} results using batch method...\n")
-  LLM_json = rerank_batch(query, doc_list_str)
-  LLM_IDs = json.loads(LLM_json)
-  print("LLM ranking:", LLM_IDs)
-  final_results = []
-  for i in LLM_IDs:
-    final_results.append(results[i])
-  return final_results
-
-def rrf_search_cross_encoder(hybrid_search: HybridSearch, query: str, k: int = 50, limit: int = 5):
-  print("Reranking top 25 results using cross_encoder method...")
-  results = hybrid_search.rrf_search(query, k, limit * 5)
-  rrf_results_log(results)
-  pairs: list[tuple[str, str]] = []
-  for r in results:
-    pairs.append( (query, f"{r['doc'].get('title', '')} - {r.get('doc', '')}"))
-  encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
-  scores = encoder.predict(pairs)
-  for i, score in enumerate(scores):
-    results[i]['encoder_score'] = score
-  return sorted(results, key=lambda item: item['encoder_score'], reverse=True)
\ No newline at end of file
+@phase("query")
+def rrf_search_reranked(hybrid_search: HybridSearch, query: str, k: int = 50, limit: int = 5, rerank_method: str | None = None, budget: QueryBudget | None = None) -> tuple[list[dict], str | None]:
+  # RRF search followed by the rerank method that fits the budget; returns the results and the method applied
+  candidates = limit * 5
+  if budget is not None:
+    rerank_method, candidates = plan_rerank(rerank_method, candidates, limit, budget)
+    budget.reserved = 0.0 if rerank_method is None else estimate_stage(rerank_method, candidates)
+  match rerank_method:
+    case "individual":
+      return rrf_search_individual(hybrid_search, query, k, limit, budget, candidates), rerank_method
+    case "batch":
+      return rrf_search_batch(hybrid_search, query, k, limit, budget), rerank_method
+    case "cross_encoder":
+      return rrf_search_cross_encoder(hybrid_search, query, k, limit, budget), rerank_method
+    case _:
+      return hybrid_search.rrf_search(query, k, limit, budget=budget), None
\ No newline at end of file
@@ -1,24 +1,49 @@
 from text_handling import process_string
 from data_handling import load_movies
-from collections import Counter
-from search_utils import BM25_K1, BM25_B
-from data_handling import CACHE_DIR, INDEX_FILE, DOCMAP_FILE, DOC_LENGTHS_FILE, TERM_FREQ_FILE
-import pickle, math, os
+from collections import Counter, OrderedDict
+from search_utils import BM25_K1, BM25_B, BM25_IMPACT_LEVELS, TOKEN_SCORE_CACHE_SIZE
+from data_handling import CACHE_DIR, INDEX_FILE, INDEX_VERSION_FILE, DOCUMENTS_FILE, DOC_LENGTHS_FILE, TERM_FREQ_FILE, IMPACTS_FILE, POSITIONS_FILE, BM25_CSR_FILE, ensure_writable_cache
+from lib.document_store import DocumentStore, as_store
+from lib.postings import encode_deltas, decode_deltas, gallop, intersect_postings, positions_within
+from lib.profiling import phase
+import pickle, math, os, hashlib, threading
 from tqdm import tqdm
 from pathlib import Path
 
+def index_version(cache_dir: str) -> str | None:
+  # Written with the index from its contents, so re-saving the same index keeps it
+  filepath = Path(cache_dir, INDEX_VERSION_FILE)
+  if not filepath.exists():
+    return None
+  return filepath.read_text()
+
+
 class InvertedIndex:
 
-  def __init__(self) -> None:
+  def __init__(self, cache_dir: str = CACHE_DIR) -> None:
     print("--- Initialize inverted index ---")
-    self.index_filepath = os.path.join(CACHE_DIR, INDEX_FILE)
-    self.index: dict[str, set[int]] =  {}
-    self.docmap_filepath = os.path.join(CACHE_DIR, DOCMAP_FILE)
-    self.docmap: dict[int, dict] = {}
-    self.doc_lengths: dict = {}
-    self.doc_lengths_filepath = os.path.join(CACHE_DIR, DOC_LENGTHS_FILE)
-    self.tf_filepath = os.path.join(CACHE_DIR, TERM_FREQ_FILE)
-    self.term_frequencies: dict[int, Counter[str]] = {}
+    self.cache_dir = cache_dir
+    self.index_filepath = os.path.join(cache_dir, INDEX_FILE)
+    # Everything below addresses documents by their row in the store; posting lists are sorted by row
+    self.index: dict[str, list[int]] =  {}
+    self.documents_filepath = os.path.join(cache_dir, DOCUMENTS_FILE)
+    self.store = DocumentStore.from_documents([])
+    self.doc_lengths: list[int] = []
+    self.doc_lengths_filepath = os.path.join(cache_dir, DOC_LENGTHS_FILE)
+    self.tf_filepath = os.path.join(cache_dir, TERM_FREQ_FILE)
+    self.term_frequencies: list[Counter[str]] = []
+    # Quantized BM25 tf components for the default k1/b, token -> {row: level}
+    self.impacts_filepath = os.path.join(cache_dir, IMPACTS_FILE)
+    self.impacts: dict[str, dict[int, int]] = {}
+    self.impact_scale = 0.0
+    # Optional positional postings, token -> (sorted rows, delta-encoded positions per row)
+    self.positions_filepath = os.path.join(cache_dir, POSITIONS_FILE)
+    self.positions: dict[str, tuple[list[int], list[bytes]]] = {}
+    # LRU of per-token BM25 score contributions, keyed by (token, k1, b)
+    self.token_score_cache: OrderedDict[tuple[str, float, float], dict[int, float]] = OrderedDict()
+    self.token_score_lock = threading.Lock()
+    # BM25 statistics of the whole collection when this index holds one shard of it
+    self.global_stats: dict | None = None
   
   def __single_term_to_token(self, term: str) -> str:
     token = process_string(term)
@@ -26,32 +51,42 @@ class InvertedIndex:
       raise ValueError("command supports single tokens only")
     return token[0]
   
+  def __content_version(self) -> str:
+    # Vocabulary with document frequencies and the document count, what the spelling and expansion tables are built from
+    digest = hashlib.sha256(str(len(self.store)).encode())
+    for token in sorted(self.index):
+      digest.update(f"\0{token}:{len(self.index[token])}".encode())
+    return digest.hexdigest()
+
   def __get_avg_doc_length(self) -> float:
+    if self.global_stats is not None:
+      return self.global_stats["avg_doc_length"]
     if len(self.doc_lengths) == 0:
       return 0.0
-    return (sum(self.doc_lengths.values()))/len(self.doc_lengths)
+    return (sum(self.doc_lengths))/len(self.doc_lengths)
 
-  def __add_document(self, doc_id: int, text: str):
+  def __add_document(self, row: int, text: str):
     tokens = process_string(text)
+    counts: Counter[str] = Counter()
     # Add tokens to index and increment term frequencies
     for token in tqdm(tokens, "Indexing", len(tokens)):
-      # index
+      # index, rows arrive in order so postings stay sorted
       if token not in self.index:
-        self.index[token] = set()
-      self.index[token].add(doc_id)
+        self.index[token] = []
+      if self.index[token][-1:] != [row]:
+        self.index[token].append(row)
       # term frequencies
-      if doc_id not in self.term_frequencies:
-        self.term_frequencies[doc_id] = Counter()
-      self.term_frequencies[doc_id].update([token])
+      counts.update([token])
+    self.term_frequencies.append(counts)
     # document lengths
-    self.doc_lengths[doc_id] = len(tokens)
+    self.doc_lengths.append(len(tokens))
 
   def get_documents(self, token: str) -> list[int]:
-    return sorted(self.index.get(token, []))
+    return self.index.get(token, [])
 
-  def get_tf(self, doc_id: int, term: str) -> int:
+  def get_tf(self, row: int, term: str) -> int:
     token = self.__single_term_to_token(term)
-    return self.term_frequencies[doc_id][token]
+    return self.term_frequencies[row][token]
   
   def get_df(self, term: str) -> int:
     token = self.__single_term_to_token(term)
@@ -59,46 +94,187 @@ class InvertedIndex:
   
   def get_idf(self, term: str) -> float:
     token = self.__single_term_to_token(term)
-    return math.log((len(self.docmap) + 1) / (len(self.index.get(token, [])) + 1))
+    return math.log((len(self.store) + 1) / (len(self.index.get(token, [])) + 1))
   
+  def __collection_size(self) -> int:
+    return len(self.store) if self.global_stats is None else self.global_stats["N"]
+
+  def __bm25_df(self, token: str) -> int:
+    if self.global_stats is None:
+      return len(self.get_documents(token))
+    return self.global_stats["df"].get(token, 0)
+
   def get_bm25_idf(self, term: str) -> float:
-    df = self.get_df(term)
-    N = len(self.docmap)
+    return self.__token_bm25_idf(self.__single_term_to_token(term))
+
+  def __token_bm25_idf(self, token: str) -> float:
+    # For tokens already processed; stemming them again could change them
+    df = self.__bm25_df(token)
+    N = self.__collection_size()
     return math.log((N - df + 0.5) / (df + 0.5) + 1)
+
+  def collection_stats(self) -> dict:
+    # The per-shard counts that merge into global BM25 statistics
+    return {
+      "N": len(self.store),
+      "total_length": sum(self.doc_lengths),
+      "df": {token: len(postings) for token, postings in self.index.items()}
+    }
+
+  def set_global_stats(self, stats: dict):
+    self.global_stats = stats
+    self.token_score_cache.clear()
+    # Impacts depend on the average document length
+    if len(self.impacts) > 0:
+      self.build_impacts()
   
-  def get_tfidf(self, doc_id: int, term: str) -> float:
-    return self.get_tf(doc_id, term) * self.get_idf(term)
+  def get_tfidf(self, row: int, term: str) -> float:
+    return self.get_tf(row, term) * self.get_idf(term)
   
-  def get_bm25_tf(self, doc_id: int, term: str, k1: float = BM25_K1, b: float = BM25_B) -> float:
-    tf = self.get_tf(doc_id, term)
-    length_norm = 1 - b + b * (self.doc_lengths[doc_id] / self.__get_avg_doc_length())
+  def get_bm25_tf(self, row: int, term: str, k1: float = BM25_K1, b: float = BM25_B) -> float:
+    if self.__use_impacts(k1, b):
+      token = self.__single_term_to_token(term)
+      return self.impacts.get(token, {}).get(row, 0) * self.impact_scale
+    return self.__bm25_saturation(self.get_tf(row, term), row, k1, b, self.__get_avg_doc_length())
+
+  def __bm25_saturation(self, tf: int, row: int, k1: float, b: float, avg_doc_length: float) -> float:
+    length_norm = 1 - b + b * (self.doc_lengths[row] / avg_doc_length)
     return (tf * (k1 + 1)) / (tf + k1 * length_norm)
 
-  def get_bm25score(self, doc_id: int, term: str):
-    return self.get_bm25_tf(doc_id, term) * self.get_bm25_idf(term)
-  
-  def bm25_search(self, query: str, limit: int = 5):
+  def get_bm25score(self, row: int, term: str, k1: float = BM25_K1, b: float = BM25_B):
+    return self.get_bm25_tf(row, term, k1, b) * self.get_bm25_idf(term)
+
+  def __use_impacts(self, k1: float, b: float) -> bool:
+    # Impacts are only valid for the parameters they were built with
+    return len(self.impacts) > 0 and k1 == BM25_K1 and b == BM25_B
+
+  def build_impacts(self):
+    # tf * (k1 + 1) / (tf + k1 * norm) is bounded by k1 + 1, so a fixed scale covers every posting
+    self.impact_scale = (BM25_K1 + 1) / BM25_IMPACT_LEVELS
+    self.token_score_cache.clear()
+    avg_doc_length = self.__get_avg_doc_length()
+    self.impacts = {}
+    for row, counts in tqdm(enumerate(self.term_frequencies), "Precomputing BM25 impacts", len(self.term_frequencies)):
+      length_norm = 1 - BM25_B + BM25_B * (self.doc_lengths[row] / avg_doc_length)
+      for token, tf in counts.items():
+        impact = (tf * (BM25_K1 + 1)) / (tf + BM25_K1 * length_norm)
+        if token not in self.impacts:
+          self.impacts[token] = {}
+        self.impacts[token][row] = round(impact / self.impact_scale)
+
+  def build_positions(self):
+    positions: dict[str, dict[int, list[int]]] = {}
+    for row in tqdm(range(len(self.store)), "Recording term positions", len(self.store)):
+      for position, token in enumerate(process_string(self.store.text(row))):
+        if token not in positions:
+          positions[token] = {}
+        if row not in positions[token]:
+          positions[token][row] = []
+        positions[token][row].append(position)
+    self.positions = {}
+    for token, docs in positions.items():
+      # rows were visited in order, so the keys are already sorted
+      self.positions[token] = (list(docs), [encode_deltas(p) for p in docs.values()])
+
+  def __term_positions(self, token: str, row: int) -> list[int]:
+    rows, encoded = self.positions[token]
+    return decode_deltas(encoded[gallop(rows, row)])
+
+  def phrase_search(self, phrases: list[tuple[str, int]]) -> list[int]:
+    # Rows containing every phrase, each phrase's tokens in order within `slop` extra positions
+    if len(self.positions) == 0:
+      raise ValueError("phrase queries need positional postings, rebuild the index with --positions")
+    phrase_tokens = [(process_string(phrase), slop) for phrase, slop in phrases]
+    all_tokens = {token for tokens, _ in phrase_tokens for token in tokens}
+    if len(all_tokens) == 0:
+      return []
+    if any(token not in self.positions for token in all_tokens):
+      return []
+    candidates = intersect_postings([self.positions[token][0] for token in all_tokens])
+    result: list[int] = []
+    for row in candidates:
+      for tokens, slop in phrase_tokens:
+        if len(tokens) > 1 and not positions_within([self.__term_positions(t, row) for t in tokens], slop):
+          break
+      else:
+        result.append(row)
+    return result
+
+  def __impact_weight(self, token: str) -> float:
+    df = self.__bm25_df(token)
+    N = self.__collection_size()
+    return math.log((N - df + 0.5) / (df + 0.5) + 1) * self.impact_scale
+
+  def __token_scores(self, token: str, k1: float, b: float) -> dict[int, float]:
+    key = (token, k1, b)
+    with self.token_score_lock:
+      if key in self.token_score_cache:
+        self.token_score_cache.move_to_end(key)
+        return self.token_score_cache[key]
+    if self.__use_impacts(k1, b):
+      # Walk the token's postings only: idf * impact per posting
+      postings = self.impacts.get(token, {})
+      weight = self.__impact_weight(token)
+      scores = {row: weight * level for row, level in postings.items()}
+    else:
+      # Only documents in the token's postings score; a tf of 0 adds nothing
+      idf = self.__token_bm25_idf(token)
+      avg_doc_length = self.__get_avg_doc_length()
+      scores = {row: self.__bm25_saturation(self.term_frequencies[row][token], row, k1, b, avg_doc_length) * idf for row in self.index.get(token, [])}
+    with self.token_score_lock:
+      self.token_score_cache[key] = scores
+      if len(self.token_score_cache) > TOKEN_SCORE_CACHE_SIZE:
+        self.token_score_cache.popitem(last=False)
+    return scores
+
+  @phase("query")
+  def bm25_search(self, query: str, limit: int = 5, k1: float = BM25_K1, b: float = BM25_B, phrases: list[tuple[str, int]] | None = None, expansions: dict[str, float] | None = None):
     # tokenize the query
     search_tokens = process_string(query)
-    # Calculate bm25 score for each document
+    # Phrases restrict scoring to the documents that contain them
+    candidates = None
+    if phrases:
+      candidates = self.phrase_search(phrases)
+      for phrase, _ in phrases:
+        search_tokens += process_string(phrase)
+    # Query tokens count fully, expansion tokens with their weight
+    weighted_tokens = [(token, 1.0) for token in search_tokens]
+    weighted_tokens += [(token, weight) for token, weight in (expansions or {}).items() if token not in search_tokens]
+    # Calculate bm25 score for each document row
     bm25_scores: dict[int, float] = {}
-    for doc_id in tqdm(self.docmap.keys(), "Calculating BM25 score", len(self.docmap)):
-      score = 0
-      for token in search_tokens:
-        score += self.get_bm25score(doc_id, token)
-      bm25_scores[doc_id] = score
-    # Sort the scores, descending
+    if candidates is None:
+      # Per-token scores are cached, so queries sharing tokens (e.g. a query and its rewrite) reuse them
+      bm25_scores = dict.fromkeys(range(len(self.store)), 0.0)
+      for token, token_weight in weighted_tokens:
+        for row, score in self.__token_scores(token, k1, b).items():
+          bm25_scores[row] += token_weight * score
+    elif self.__use_impacts(k1, b):
+      bm25_scores = dict.fromkeys(candidates, 0.0)
+      for token, token_weight in weighted_tokens:
+        postings = self.impacts.get(token, {})
+        weight = token_weight * self.__impact_weight(token)
+        for row in candidates:
+          bm25_scores[row] += weight * postings.get(row, 0)
+    else:
+      bm25_scores = dict.fromkeys(candidates, 0.0)
+      for token, token_weight in weighted_tokens:
+        scores = self.__token_scores(token, k1, b)
+        for row in candidates:
+          bm25_scores[row] += token_weight * scores.get(row, 0.0)
+    # Sort the (row, score) pairs, descending
     sorted_scores: list[tuple[int, float]] = sorted(bm25_scores.items(), key=lambda item: item[1], reverse=True)
     # Pick the top results by limit
     top_scores = sorted_scores[:limit]
     return top_scores
 
-  def build(self):
+  @phase("cache load")
+  def build(self, impacts: bool = False, positions: bool = False, documents: list[dict] | DocumentStore | None = None):
     # Only build if all cache files exist
     files = [
-      Path(CACHE_DIR, DOC_LENGTHS_FILE),
-      Path(CACHE_DIR, INDEX_FILE),
-      Path(CACHE_DIR, TERM_FREQ_FILE)
+      Path(self.cache_dir, DOCUMENTS_FILE),
+      Path(self.cache_dir, DOC_LENGTHS_FILE),
+      Path(self.cache_dir, INDEX_FILE),
+      Path(self.cache_dir, TERM_FREQ_FILE)
     ]
     for f in files:
       if not f.exists():
@@ -106,42 +282,72 @@ class InvertedIndex:
     else:
       print("Cache directory already exists, loading data for inverted index...")
       self.load()
+      if impacts and len(self.impacts) == 0:
+        ensure_writable_cache(self.cache_dir, "no BM25 impacts for the current parameters, see --impacts")
+        self.build_impacts()
+        self.save()
+      if positions and len(self.positions) == 0:
+        ensure_writable_cache(self.cache_dir, "no positional postings, see --positions")
+        self.build_positions()
+        self.save()
       return
+    ensure_writable_cache(self.cache_dir, "inverted index files are missing")
     # First load data into memory
-    movies = load_movies()["movies"]
-    for m in tqdm(movies, "Adding documents", len(movies)):
-      self.__add_document(int(m["id"]), f"{m['title']} {m['description']}")
-      self.docmap[int(m["id"])] = m
+    self.store = as_store(load_movies()["movies"] if documents is None else documents)
+    for row in tqdm(range(len(self.store)), "Adding documents", len(self.store)):
+      self.__add_document(row, self.store.text(row))
+    # Caches derived from an earlier build are keyed by its rows and tokens
+    Path(self.impacts_filepath).unlink(missing_ok=True)
+    Path(self.positions_filepath).unlink(missing_ok=True)
+    Path(self.cache_dir, BM25_CSR_FILE).unlink(missing_ok=True)
+    if impacts:
+      self.build_impacts()
+    if positions:
+      self.build_positions()
     # Save to file
     self.save()
 
   def save(self):
     # Ensure directory exists
-    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
     # Write index cache
     with open(self.index_filepath, "wb") as file:
       pickle.dump(self.index, file)
-    # Write docmap cache
-    with open(self.docmap_filepath, "wb") as file:
-      pickle.dump(self.docmap, file)
+    Path(self.cache_dir, INDEX_VERSION_FILE).write_text(self.__content_version())
+    # Write document store
+    self.store.save(self.documents_filepath)
     # Write tf cache
     with open(self.tf_filepath, "wb") as file:
       pickle.dump(self.term_frequencies, file)
     # Write doc_lengths cache
     with open(self.doc_lengths_filepath, "wb") as file:
       pickle.dump(self.doc_lengths, file)
+    # Write impacts cache
+    if len(self.impacts) > 0:
+      with open(self.impacts_filepath, "wb") as file:
+        pickle.dump({"k1": BM25_K1, "b": BM25_B, "scale": self.impact_scale, "impacts": self.impacts}, file)
+    # Write positions cache
+    if len(self.positions) > 0:
+      with open(self.positions_filepath, "wb") as file:
+        pickle.dump(self.positions, file)
   
+  @phase("cache load")
   def load(self):
+    self.token_score_cache.clear()
     try:
       with open(self.index_filepath, "rb") as file:
         self.index = pickle.load(file)
-      with open(self.docmap_filepath, "rb") as file:
-        self.docmap = pickle.load(file)
+      self.store = DocumentStore.load(self.documents_filepath)
       with open(self.tf_filepath, "rb") as file:
         self.term_frequencies = pickle.load(file)
       with open(self.doc_lengths_filepath, "rb") as file:
         self.doc_lengths = pickle.load(file)
+      self.load_impacts()
+      if Path(self.positions_filepath).exists():
+        with open(self.positions_filepath, "rb") as file:
+          self.positions = pickle.load(file)
     except FileNotFoundError:
+      ensure_writable_cache(self.cache_dir, "inverted index files are missing")
       print("Cache file missing.")
       while True:
         want_cache = input("Build a new cache? (Y/N)\n")
@@ -149,11 +355,24 @@ class InvertedIndex:
           break
         if want_cache.lower() == "y":
           files = [
-            Path(CACHE_DIR, DOC_LENGTHS_FILE),
-            Path(CACHE_DIR, INDEX_FILE),
-            Path(CACHE_DIR, TERM_FREQ_FILE)
+            Path(self.cache_dir, DOCUMENTS_FILE),
+            Path(self.cache_dir, DOC_LENGTHS_FILE),
+            Path(self.cache_dir, INDEX_FILE),
+            Path(self.cache_dir, TERM_FREQ_FILE)
           ]
           for f in files:
             f.unlink(missing_ok=True)
           self.build()
-          break
\ No newline at end of file
+          break
+
+  def load_impacts(self):
+    # Impacts are optional; stale ones built for other parameters are ignored
+    if not Path(self.impacts_filepath).exists():
+      return
+    with open(self.impacts_filepath, "rb") as file:
+      cached = pickle.load(file)
+    if cached["k1"] != BM25_K1 or cached["b"] != BM25_B:
+      print("BM25 impacts were built with different parameters, ignoring them.")
+      return
+    self.impact_scale = cached["scale"]
+    self.impacts = cached["impacts"]
\ No newline at end of file
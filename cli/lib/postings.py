@@ -0,0 +1,77 @@
+from bisect import bisect_left
+
+
+def encode_deltas(values: list[int]) -> bytes:
+  # Sorted ints stored as varint-encoded gaps
+  result = bytearray()
+  previous = 0
+  for v in values:
+    gap = v - previous
+    previous = v
+    while gap >= 0x80:
+      result.append((gap & 0x7F) | 0x80)
+      gap >>= 7
+    result.append(gap)
+  return bytes(result)
+
+def decode_deltas(data: bytes) -> list[int]:
+  result: list[int] = []
+  current = 0
+  gap = 0
+  shift = 0
+  for byte in data:
+    gap |= (byte & 0x7F) << shift
+    if byte & 0x80:
+      shift += 7
+      continue
+    current += gap
+    result.append(current)
+    gap = 0
+    shift = 0
+  return result
+
+def gallop(postings: list[int], target: int, start: int = 0) -> int:
+  # Index of the first posting >= target, probing 1, 2, 4, ... steps ahead before bisecting
+  step = 1
+  end = start
+  while end < len(postings) and postings[end] < target:
+    start = end + 1
+    end += step
+    step *= 2
+  return bisect_left(postings, target, start, min(end + 1, len(postings)))
+
+def intersect_postings(posting_lists: list[list[int]]) -> list[int]:
+  if len(posting_lists) == 0:
+    return []
+  # Smallest list drives the merge, the others are galloped through
+  ordered = sorted(posting_lists, key=len)
+  result = ordered[0]
+  for postings in ordered[1:]:
+    matches: list[int] = []
+    i = 0
+    for doc_id in result:
+      i = gallop(postings, doc_id, i)
+      if i == len(postings):
+        break
+      if postings[i] == doc_id:
+        matches.append(doc_id)
+    result = matches
+    if len(result) == 0:
+      break
+  return result
+
+def positions_within(positions: list[list[int]], slop: int = 0) -> bool:
+  # True if the terms occur in order with at most `slop` extra positions in between
+  max_span = len(positions) - 1 + slop
+  for first in positions[0]:
+    previous = first
+    for term_positions in positions[1:]:
+      i = bisect_left(term_positions, previous + 1)
+      if i == len(term_positions):
+        return False
+      previous = term_positions[i]
+      if previous - first > max_span:
+        break
+    else:
+      return True
+  return False
@@ -0,0 +1,197 @@
+from data_handling import PROFILES_DIR
+from search_utils import PROFILE_TOP_FUNCTIONS, PROFILE_TOP_ALLOCATIONS, PROFILE_MIN_STACK_SECONDS, PROFILE_MAX_STACK_DEPTH
+from contextlib import ContextDecorator, contextmanager
+from pathlib import Path
+from time import perf_counter
+import argparse, cProfile, json, pstats, sys, threading, time, tracemalloc
+
+# --profile on any CLI runs the command under cProfile and tracemalloc. Code
+# marks its phases (model load, cache load, query) with @phase(...); phases
+# record wall time, peak and net allocated memory and their top allocation
+# sites. Without a session a phase is a single attribute check. The profiler
+# keeps running through phase bookkeeping (disabling it would cut the open
+# frames short), so snapshot time shows up under this module's frames.
+
+session: "ProfileSession | None" = None
+# Per thread: whether each open phase is being recorded
+phase_flags = threading.local()
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+  parser.add_argument("--profile", action="store_true", help=f"Record cProfile stats and tracemalloc snapshots of this run under {PROFILES_DIR}/")
+
+@contextmanager
+def profile_session(args: argparse.Namespace, cli_name: str):
+  global session
+  if not getattr(args, "profile", False):
+    yield
+    return
+  command = getattr(args, "command", None)
+  session = ProfileSession(cli_name if command is None else f"{cli_name}-{command}")
+  session.start()
+  try:
+    yield
+  finally:
+    current, session = session, None
+    current.finish()
+
+
+class phase(ContextDecorator):
+  def __init__(self, name: str) -> None:
+    self.name = name
+
+  def __enter__(self):
+    flags = phase_flags.__dict__.setdefault("stack", [])
+    flags.append(session is not None and session.enter(self.name))
+    return self
+
+  def __exit__(self, *exc):
+    if phase_flags.stack.pop() and session is not None:
+      session.exit()
+    return False
+
+
+class ProfileSession:
+  def __init__(self, name: str) -> None:
+    self.name = name
+    self.profiler = cProfile.Profile()
+    # Phases are recorded on the thread that runs the command; worker threads only show up in cProfile
+    self.thread = threading.get_ident()
+    # Open phases: name, traced memory at start, peak so far, start snapshot, start time
+    self.stack: list[dict] = []
+    # Traced bytes held by phase snapshots
+    self.held = 0
+    # name -> aggregate over every occurrence
+    self.phases: dict[str, dict] = {}
+
+  def start(self):
+    tracemalloc.start()
+    self.started = perf_counter()
+    self.root = {"name": self.name, "peak": 0}
+    self.profiler.enable()
+
+  def enter(self, name: str) -> bool:
+    # Nested occurrences of an open phase count towards the outer one
+    if threading.get_ident() != self.thread or any(open_phase["name"] == name for open_phase in self.stack):
+      return False
+    parent = self.stack[-1] if self.stack else self.root
+    _, peak = tracemalloc.get_traced_memory()
+    parent["peak"] = max(parent["peak"], peak - self.held)
+    snapshot, current = self.__snapshot()
+    tracemalloc.reset_peak()
+    self.stack.append({"name": name, "memory": current, "peak": current - self.held, "snapshot": snapshot, "start": perf_counter()})
+    return True
+
+  def exit(self):
+    entry = self.stack.pop()
+    seconds = perf_counter() - entry["start"]
+    current, peak = tracemalloc.get_traced_memory()
+    peak = max(entry["peak"], peak - self.held)
+    parent = self.stack[-1] if self.stack else self.root
+    parent["peak"] = max(parent["peak"], peak)
+    record = self.phases.setdefault(entry["name"], {"calls": 0, "seconds": 0.0, "peak_bytes": 0, "allocated_bytes": 0, "snapshots": []})
+    record["calls"] += 1
+    record["seconds"] += seconds
+    record["peak_bytes"] = max(record["peak_bytes"], peak)
+    record["allocated_bytes"] += current - entry["memory"]
+    record["snapshots"].append((entry["snapshot"], self.__snapshot()[0]))
+    # The parent's peak so far is in its entry; the snapshot above is not part of it
+    tracemalloc.reset_peak()
+
+  def __snapshot(self) -> tuple[tracemalloc.Snapshot, int]:
+    # Snapshots are compared after the run: comparing is pure Python and would
+    # swamp the profile. Until then they are held, and not counted as phase memory.
+    before, _ = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    current, _ = tracemalloc.get_traced_memory()
+    self.held += current - before
+    return snapshot, current
+
+  def finish(self):
+    self.profiler.disable()
+    seconds = perf_counter() - self.started
+    _, peak = tracemalloc.get_traced_memory()
+    final = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    out_dir = Path(PROFILES_DIR, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    self.profiler.dump_stats(out_dir / "profile.pstats")
+    stats = pstats.Stats(self.profiler).stats
+    with open(out_dir / "profile.collapsed", "w") as file:
+      for stack, weight in sorted(collapsed_stacks(stats).items()):
+        file.write(f"{stack} {round(weight * 1e6)}\n")
+    summary = {
+      "command": self.name,
+      "argv": sys.argv,
+      "wall_seconds": seconds,
+      "peak_mb": max(self.root["peak"], peak - self.held) / 1e6,
+      "phases": {name: phase_summary(record) for name, record in self.phases.items()},
+      "top_tottime": top_functions(stats, 2),
+      "top_cumtime": top_functions(stats, 3),
+      "live_allocations": [
+        {"where": allocation_site(stat), "kb": stat.size / 1e3, "count": stat.count}
+        for stat in final.statistics("lineno") if not own_allocation(stat)
+      ][:PROFILE_TOP_ALLOCATIONS]
+    }
+    with open(out_dir / "summary.json", "w") as file:
+      json.dump(summary, file, indent=2)
+    print(f"\nProfile: {seconds:.2f}s, peak {summary['peak_mb']:.1f} MB, written to {out_dir}/", file=sys.stderr)
+    for name, record in summary["phases"].items():
+      print(f"  {name}: {record['seconds']:.3f}s in {record['calls']} call(s), peak {record['peak_mb']:.1f} MB", file=sys.stderr)
+    for entry in summary["top_tottime"][:5]:
+      print(f"  {entry['tottime']:.3f}s self, {entry['calls']} calls: {entry['function']}", file=sys.stderr)
+
+
+def function_label(func: tuple[str, int, str]) -> str:
+  filename, line, name = func
+  return name if filename == "~" else f"{Path(filename).name}:{line}({name})"
+
+def top_functions(stats: dict, column: int) -> list[dict]:
+  # column 2 is self time, 3 cumulative time
+  ranked = sorted(stats.items(), key=lambda item: item[1][column], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+  return [{"function": function_label(func), "calls": nc, "tottime": tt, "cumtime": ct} for func, (cc, nc, tt, ct, callers) in ranked]
+
+def allocation_site(stat: tracemalloc.Statistic | tracemalloc.StatisticDiff) -> str:
+  return f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}"
+
+def own_allocation(stat: tracemalloc.Statistic | tracemalloc.StatisticDiff) -> bool:
+  # The profiler's own bookkeeping is left out
+  return stat.traceback[0].filename in (tracemalloc.__file__, __file__)
+
+def phase_summary(record: dict) -> dict:
+  # Growth per allocation site, summed over every occurrence of the phase
+  allocations: dict[str, tuple[int, int]] = {}
+  for start, end in record["snapshots"]:
+    for stat in end.compare_to(start, "lineno"):
+      if stat.size_diff > 0 and not own_allocation(stat):
+        size, count = allocations.get(allocation_site(stat), (0, 0))
+        allocations[allocation_site(stat)] = (size + stat.size_diff, count + stat.count_diff)
+  top = sorted(allocations.items(), key=lambda item: item[1][0], reverse=True)[:PROFILE_TOP_ALLOCATIONS]
+  return {
+    "calls": record["calls"],
+    "seconds": record["seconds"],
+    "peak_mb": record["peak_bytes"] / 1e6,
+    "allocated_mb": record["allocated_bytes"] / 1e6,
+    "top_allocations": [{"where": where, "kb": size / 1e3, "count": count} for where, (size, count) in top]
+  }
+
+def collapsed_stacks(stats: dict) -> dict[str, float]:
+  # cProfile keeps caller -> callee edges, not whole stacks. Each function's self
+  # time is walked up its callers, split by the cumulative time each caller edge
+  # accounts for; shares below PROFILE_MIN_STACK_SECONDS are dropped.
+  stacks: dict[str, float] = {}
+  def climb(path: list[tuple], weight: float):
+    callers = {caller: edge for caller, edge in stats[path[-1]][4].items() if caller in stats and caller not in path}
+    total = sum(edge[3] for edge in callers.values())
+    if total <= 0 or len(path) >= PROFILE_MAX_STACK_DEPTH:
+      stack = ";".join(function_label(func) for func in reversed(path))
+      stacks[stack] = stacks.get(stack, 0.0) + weight
+      return
+    for caller, edge in callers.items():
+      share = weight * edge[3] / total
+      if share >= PROFILE_MIN_STACK_SECONDS:
+        climb(path + [caller], share)
+  for func, (cc, nc, tt, ct, callers) in stats.items():
+    if tt >= PROFILE_MIN_STACK_SECONDS:
+      climb([func], tt)
+  return stacks
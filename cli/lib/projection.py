@@ -0,0 +1,36 @@
+from data_handling import ensure_writable_cache
+from pathlib import Path
+import numpy as np
+
+
+def fit_pca(embeddings: np.ndarray, dims: int) -> np.ndarray:
+  # Principal axes of the uncentered second moment matrix, largest first. Without
+  # centering, (P q) . (P x) is the best rank-dims approximation of the dot product q . x
+  if not 0 < dims <= embeddings.shape[1]:
+    raise ValueError(f"reduced dimensions must be between 1 and {embeddings.shape[1]}, got {dims}")
+  data = np.asarray(embeddings, dtype=np.float64)
+  eigenvalues, eigenvectors = np.linalg.eigh(data.T @ data)
+  order = np.argsort(eigenvalues)[::-1][:dims]
+  kept = eigenvalues[order].sum() / eigenvalues.sum() if eigenvalues.sum() > 0 else 1.0
+  print(f"Projection to {dims} dimensions keeps {kept:.1%} of the energy")
+  return eigenvectors[:, order].T.astype(np.float32)
+
+def project(vectors: np.ndarray, components: np.ndarray) -> np.ndarray:
+  return np.asarray(vectors, dtype=np.float32) @ components.T
+
+def load_or_fit_projection(embeddings: np.ndarray, dims: int, filepath: str | Path, fingerprint: str) -> tuple[np.ndarray, np.ndarray]:
+  # (components, reduced vectors), cached next to the full embeddings and tied to their fingerprint
+  filepath = Path(filepath)
+  if filepath.exists():
+    with np.load(filepath) as cached:
+      if str(cached["fingerprint"]) == fingerprint:
+        print(f"Loading {dims}-dimensional projection from {filepath}...")
+        return cached["components"], cached["vectors"]
+    print("Projection does not match the chunk embeddings. Refitting...")
+  ensure_writable_cache(str(filepath.parent), f"no {dims}-dimensional projection of the chunk embeddings, see --reduced-dims")
+  components = fit_pca(embeddings, dims)
+  vectors = project(embeddings, components)
+  with open(filepath, "wb") as file:
+    np.savez(file, fingerprint=np.array(fingerprint), components=components, vectors=vectors)
+  print(f"Projection written to {filepath}")
+  return components, vectors
@@ -0,0 +1,59 @@
+from search_utils import BUDGET_STAGE_SECONDS, BUDGET_ESTIMATE_SMOOTHING, BUDGET_MIN_DEPTH_FACTOR
+from time import monotonic
+import threading
+
+# Stage latency estimates for planning against a budget, seeded from
+# BUDGET_STAGE_SECONDS and moved towards every measured run in this process
+stage_seconds = dict(BUDGET_STAGE_SECONDS)
+stage_lock = threading.Lock()
+
+
+def record_stage(stage: str, seconds: float):
+  with stage_lock:
+    stage_seconds[stage] += BUDGET_ESTIMATE_SMOOTHING * (seconds - stage_seconds[stage])
+
+def record_retrieval(depth: int, full_depth: int, degraded: list[str], start: float):
+  # A shallow run degrades to "depth"; complete full-depth runs keep the retrieval estimate current
+  if depth < full_depth:
+    degraded.append("depth")
+  elif len(degraded) == 0:
+    record_stage("retrieve", monotonic() - start)
+
+def estimate_stage(stage: str, candidates: int = 1) -> float:
+  # Individual reranking is one LLM call per candidate, the other stages are one call each
+  with stage_lock:
+    return stage_seconds[stage] * (candidates if stage == "individual" else 1)
+
+
+class QueryBudget:
+  # Wall-clock allowance for one query, counted from creation. Stages plan against
+  # what is left after the time reserved for later stages, and record how they degraded.
+  def __init__(self, seconds: float) -> None:
+    self.seconds = seconds
+    self.deadline = monotonic() + seconds
+    # Held back for the stages after retrieval, e.g. reranking
+    self.reserved = 0.0
+    self.degradations: list[str] = []
+
+  def elapsed(self) -> float:
+    return monotonic() - (self.deadline - self.seconds)
+
+  def remaining(self) -> float:
+    return max(0.0, self.deadline - monotonic())
+
+  def available(self) -> float:
+    return max(0.0, self.remaining() - self.reserved)
+
+  def degrade(self, degradation: str):
+    self.degradations.append(degradation)
+    print(f"Budget: {degradation}")
+
+
+def plan_depth(depth: int, limit: int, budget: QueryBudget | None) -> int:
+  # Candidate depth per retriever; shallow when a full-depth retrieval does not fit
+  if budget is None or estimate_stage("retrieve") <= budget.available():
+    return depth
+  reduced = min(depth, limit * BUDGET_MIN_DEPTH_FACTOR)
+  if reduced < depth:
+    budget.degrade(f"candidate depth {depth} -> {reduced}")
+  return reduced
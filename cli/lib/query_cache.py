@@ -0,0 +1,67 @@
+from search_utils import QUERY_CACHE_SIZE, QUERY_CACHE_THRESHOLD
+import numpy as np, threading
+
+
+class SemanticQueryCache:
+  # Result cache keyed by query meaning: a query whose embedding is within the
+  # cosine threshold of a cached query's, with the same search parameters and
+  # index version, gets the cached results. Embeddings sit in one matrix, so a
+  # lookup is a single matrix-vector product.
+  def __init__(self, capacity: int = QUERY_CACHE_SIZE, threshold: float = QUERY_CACHE_THRESHOLD) -> None:
+    self.capacity = capacity
+    self.threshold = threshold
+    self.lock = threading.Lock()
+    self.embeddings: np.ndarray | None = None
+    # Per slot: the query, its search parameters, index version and results, or None when free
+    self.entries: list[tuple[str, tuple, str, list] | None] = [None] * capacity
+    self.last_used = np.zeros(capacity, dtype=np.int64)
+    self.clock = 0
+    self.hits = 0
+    self.misses = 0
+
+  def __normalize(self, embedding: np.ndarray) -> np.ndarray:
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm > 0 else embedding
+
+  def get(self, embedding: np.ndarray, key: tuple, version: str) -> tuple[str, float, list] | None:
+    # (cached query, cosine similarity, results) of the closest usable entry
+    with self.lock:
+      self.clock += 1
+      if self.embeddings is None:
+        self.misses += 1
+        return None
+      similarities = self.embeddings @ self.__normalize(embedding)
+      usable = np.array([entry is not None and entry[1] == key and entry[2] == version for entry in self.entries])
+      similarities[~usable] = -np.inf
+      slot = int(np.argmax(similarities))
+      if similarities[slot] < self.threshold:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.last_used[slot] = self.clock
+      query, _, _, results = self.entries[slot]
+      return query, float(similarities[slot]), list(results)
+
+  def put(self, embedding: np.ndarray, query: str, key: tuple, version: str, results: list):
+    with self.lock:
+      self.clock += 1
+      embedding = self.__normalize(embedding)
+      if self.embeddings is None:
+        self.embeddings = np.zeros((self.capacity, len(embedding)), dtype=np.float32)
+      # A free slot, then entries of an older index version, then the least recently used
+      stale = [i for i, entry in enumerate(self.entries) if entry is None or entry[2] != version]
+      slot = stale[0] if stale else int(np.argmin(self.last_used))
+      self.embeddings[slot] = embedding
+      self.entries[slot] = (query, key, version, list(results))
+      self.last_used[slot] = self.clock
+
+  def stats(self) -> dict:
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        "entries": sum(entry is not None for entry in self.entries)
+      }
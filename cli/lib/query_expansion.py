@@ -0,0 +1,151 @@
+from lib.inverted_index import InvertedIndex, index_version
+from lib.profiling import phase
+from text_handling import normalize_string, process_string, stem_words
+from data_handling import CACHE_DIR, EXPANSIONS_FILE, load_stopwords, ensure_writable_cache
+from search_utils import *
+from sentence_transformers import SentenceTransformer
+from collections import Counter
+from pathlib import Path
+import numpy as np, pickle
+
+# Expansion terms are precomputed per index token from two sources: terms that
+# co-occur in the same documents (cosine of their document sets) and terms whose
+# embeddings are close. At query time expansion is a dictionary lookup.
+
+# Settings the table is built with; a table built with other values is stale
+EXPANSION_PARAMETERS = {
+  "min_df": EXPANSION_MIN_DF,
+  "max_df_ratio": EXPANSION_MAX_DF_RATIO,
+  "min_cooccurrence": EXPANSION_MIN_COOCCURRENCE,
+  "neighbours": EXPANSION_NEIGHBOURS,
+  "cooccurrence_share": EXPANSION_COOCCURRENCE_SHARE,
+  "min_similarity": EXPANSION_MIN_SIMILARITY,
+  "terms": EXPANSION_TERMS,
+  "weight": EXPANSION_WEIGHT
+}
+
+
+def top_neighbours(similarities: np.ndarray, k: int) -> np.ndarray:
+  # Column ids of the k largest entries of a row, largest first
+  k = min(k, len(similarities))
+  top = np.argpartition(-similarities, k - 1)[:k]
+  return top[np.argsort(-similarities[top], kind="stable")]
+
+
+class QueryExpander:
+  def __init__(self) -> None:
+    # index token -> [(expansion token, weight)], strongest first
+    self.table: dict[str, list[tuple[str, float]]] = {}
+    # index token -> its most common surface word, for display
+    self.surface: dict[str, str] = {}
+
+  def build(self, idx: InvertedIndex, model: SentenceTransformer):
+    N = len(idx.store)
+    vocab = sorted(token for token, postings in idx.index.items() if EXPANSION_MIN_DF <= len(postings) <= EXPANSION_MAX_DF_RATIO * N)
+    if len(vocab) == 0:
+      print("Expansion table: no terms to expand")
+      return
+    columns = {token: c for c, token in enumerate(vocab)}
+    df = np.array([len(idx.index[token]) for token in vocab], dtype=np.float64)
+    cooccurrence = self.__cooccurrence_neighbours(idx, vocab, columns, df)
+    self.surface = self.__surface_words(idx, columns)
+    embedding = self.__embedding_neighbours(model, [self.surface[token] for token in vocab])
+    self.table = {}
+    for c, token in enumerate(vocab):
+      scores: dict[int, float] = {}
+      for neighbour, similarity in cooccurrence[c]:
+        scores[neighbour] = scores.get(neighbour, 0.0) + EXPANSION_COOCCURRENCE_SHARE * similarity
+      for neighbour, similarity in embedding[c]:
+        scores[neighbour] = scores.get(neighbour, 0.0) + (1 - EXPANSION_COOCCURRENCE_SHARE) * similarity
+      ranked = sorted(((n, s) for n, s in scores.items() if s >= EXPANSION_MIN_SIMILARITY), key=lambda item: (-item[1], item[0]))
+      if ranked:
+        self.table[token] = [(vocab[n], EXPANSION_WEIGHT * s) for n, s in ranked[:EXPANSION_TERMS]]
+    print(f"Expansion table: {len(self.table)} of {len(vocab)} terms have expansions")
+
+  def __cooccurrence_neighbours(self, idx: InvertedIndex, vocab: list[str], columns: dict[str, int], df: np.ndarray) -> list[list[tuple[int, float]]]:
+    # Document-term incidence in CSR layout, from the per-row term frequencies
+    indptr = [0]
+    indices: list[int] = []
+    for counts in idx.term_frequencies:
+      indices.extend(columns[token] for token in counts if token in columns)
+      indptr.append(len(indices))
+    indices_array = np.array(indices, dtype=np.int64)
+    neighbours: list[list[tuple[int, float]]] = []
+    for c, token in enumerate(vocab):
+      counts = np.bincount(np.concatenate([indices_array[indptr[r]:indptr[r + 1]] for r in idx.index[token]]), minlength=len(vocab)).astype(np.float64)
+      counts[c] = 0
+      counts[counts < EXPANSION_MIN_COOCCURRENCE] = 0
+      similarities = counts / np.sqrt(df[c] * df)
+      neighbours.append([(int(n), float(similarities[n])) for n in top_neighbours(similarities, EXPANSION_NEIGHBOURS) if similarities[n] > 0])
+    return neighbours
+
+  def __surface_words(self, idx: InvertedIndex, columns: dict[str, int]) -> dict[str, str]:
+    counts: Counter[str] = Counter()
+    for row in range(len(idx.store)):
+      counts.update(normalize_string(idx.store.text(row)).split())
+    stopwords = set(load_stopwords())
+    words = [word for word in counts if word not in stopwords]
+    surface: dict[str, str] = {}
+    for word, token in sorted(zip(words, stem_words(words)), key=lambda item: -counts[item[0]]):
+      if token in columns and token not in surface:
+        surface[token] = word
+    # Tokens seen only through other tokenization paths fall back to themselves
+    for token in columns:
+      surface.setdefault(token, token)
+    return surface
+
+  def __embedding_neighbours(self, model: SentenceTransformer, words: list[str]) -> list[list[tuple[int, float]]]:
+    embeddings = np.asarray(model.encode(words, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True), dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms != 0)
+    neighbours: list[list[tuple[int, float]]] = []
+    # Blocks of rows keep the similarity matrix out of memory
+    for start in range(0, len(words), EXPANSION_BLOCK_SIZE):
+      similarities = embeddings[start:start + EXPANSION_BLOCK_SIZE] @ embeddings.T
+      for i, row in enumerate(similarities):
+        row[start + i] = 0
+        neighbours.append([(int(n), float(row[n])) for n in top_neighbours(row, EXPANSION_NEIGHBOURS) if row[n] > 0])
+    return neighbours
+
+  def expand(self, query: str) -> dict[str, float]:
+    # Expansion token -> weight, for tokens not already in the query
+    tokens = process_string(query)
+    expansions: dict[str, float] = {}
+    for token in tokens:
+      for expansion, weight in self.table.get(token, []):
+        if expansion not in tokens:
+          expansions[expansion] = max(expansions.get(expansion, 0.0), weight)
+    return expansions
+
+  def describe(self, expansions: dict[str, float]) -> str:
+    return ", ".join(f"{self.surface.get(token, token)} ({weight:.2f})" for token, weight in sorted(expansions.items(), key=lambda item: -item[1]))
+
+  def save(self, filepath: str | Path, version: str | None):
+    with open(filepath, "wb") as file:
+      pickle.dump({"index_version": version, "parameters": EXPANSION_PARAMETERS, "table": self.table, "surface": self.surface}, file)
+
+  def load(self, filepath: str | Path, version: str | None) -> bool:
+    # A table built from another index or with other parameters is stale
+    with open(filepath, "rb") as file:
+      cached = pickle.load(file)
+    if cached.get("index_version") != version or cached.get("parameters") != EXPANSION_PARAMETERS:
+      return False
+    self.table = cached["table"]
+    self.surface = cached["surface"]
+    return True
+
+
+@phase("cache load")
+def load_or_build_expansions(idx: InvertedIndex, model: SentenceTransformer, cache_dir: str = CACHE_DIR) -> QueryExpander:
+  expander = QueryExpander()
+  filepath = Path(cache_dir, EXPANSIONS_FILE)
+  if filepath.exists():
+    print(f"Loading expansion table from {filepath}...")
+    if expander.load(filepath, index_version(cache_dir)):
+      return expander
+    print("Expansion table does not match the index or the expansion settings.")
+  ensure_writable_cache(cache_dir, "the query expansion table is missing or stale, see --expansions")
+  print("Building expansion table from the inverted index and vocabulary embeddings...")
+  expander.build(idx, model)
+  expander.save(filepath, index_version(cache_dir))
+  return expander
@@ -1,68 +1,94 @@
 from sentence_transformers import SentenceTransformer
 import numpy as np, pathlib, os
 from search_utils import *
-from data_handling import load_movies, CACHE_DIR, MOVIE_EMBEDDINGS_FILE
+from data_handling import load_movies, CACHE_DIR, MOVIE_EMBEDDINGS_FILE, MOVIE_VECTOR_ROWS_FILE
+from lib.encode_pipeline import encode_unique
+from lib.document_store import DocumentStore, as_store
+from lib.encoders import configure_threads, create_query_encoder, warm_up
+from lib.profiling import phase
 from tqdm import tqdm
 
 class SemanticSearch:
 
-  def __init__(self, model_name: str = "all-MiniLM-L6-v2") -> None:
+  def __init__(self, model_name: str = "all-MiniLM-L6-v2", cache_dir: str = CACHE_DIR, encoder_backend: str = DEFAULT_ENCODER_BACKEND, num_threads: int | None = None) -> None:
     print("--- Initalize semantic search ---")
-    self.model = SentenceTransformer(model_name)
+    configure_threads(num_threads)
+    # Documents are always encoded with the full model, queries with the selected backend
+    self.model_name = model_name
+    with phase("model load"):
+      self.model = SentenceTransformer(model_name)
+      self.query_model = create_query_encoder(self.model, encoder_backend)
+    self.cache_dir = cache_dir
     self.embeddings = None
-    self.embeddings_filepath = os.path.join(CACHE_DIR, MOVIE_EMBEDDINGS_FILE)
-    self.documents = None
-    self.document_map = {}
+    self.embeddings_filepath = os.path.join(cache_dir, MOVIE_EMBEDDINGS_FILE)
+    # The cache holds one vector per distinct text, this file maps each document to its row
+    self.vector_rows_filepath = os.path.join(cache_dir, MOVIE_VECTOR_ROWS_FILE)
+    # Shared with the inverted index when both search the same corpus
+    self.store: DocumentStore | None = None
+    # The last query and its embedding, so a query embedded for a cache lookup is not encoded twice
+    self.last_embedding: tuple[str, np.ndarray] | None = None
+
+  @phase("model load")
+  def warm_up(self):
+    # Only engines that answer queries warm up; building caches does not need it
+    warm_up(self.query_model)
 
   def generate_embedding(self, text: str):
     text = text.strip()
     if text == "":
       raise ValueError("SemanticSearch - generate embedding: text input is empty")
-    embeddings = self.model.encode([text])
+    last = self.last_embedding
+    if last is not None and last[0] == text:
+      return last[1]
+    embeddings = self.query_model.encode([text])
+    self.last_embedding = (text, embeddings[0])
     return embeddings[0]
   
-  def build_embeddings(self, documents: list[dict]):
-    self.documents = documents
-    string_docs = []
-    for doc in documents:
-      self.document_map[doc["id"]] = doc
-      string_docs.append(f"{doc['title']}: {doc['description']}")
+  def build_embeddings(self, documents: list[dict] | DocumentStore):
+    self.store = as_store(documents)
+    string_docs = [f"{self.store.title(row)}: {self.store.description(row)}" for row in range(len(self.store))]
     print("Encoding embeddings...")
-    self.embeddings = self.model.encode(string_docs, show_progress_bar=True)
-    self.save_embeddings()
+    vectors, vector_rows = encode_unique(self.model, string_docs, self.embeddings_filepath)
+    np.save(self.vector_rows_filepath, vector_rows)
+    self.embeddings = vectors[vector_rows]
     return self.embeddings
   
   def save_embeddings(self):
     if self.embeddings is None:
       return print("No embeddings to save")
-    pathlib.Path(CACHE_DIR).mkdir(exist_ok=True)
+    pathlib.Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
     with open(self.embeddings_filepath, "wb") as file:
       print(f"Saving embeddings to {self.embeddings_filepath}")
       np.save(file, self.embeddings)
+    # The saved matrix already has one row per document
+    pathlib.Path(self.vector_rows_filepath).unlink(missing_ok=True)
   
-  def load_or_create_embeddings(self, documents: list[dict]):
-    self.documents = documents
-    print("Building doc map...")
-    for doc in documents:
-      self.document_map[doc["id"]] = doc
+  @phase("cache load")
+  def load_or_create_embeddings(self, documents: list[dict] | DocumentStore):
+    self.store = as_store(documents)
     if pathlib.Path(self.embeddings_filepath).exists():
       print(f"Loading embeddings from {self.embeddings_filepath}...")
       self.embeddings = np.load(self.embeddings_filepath)
-      if len(self.embeddings) == len(self.documents):
+      if pathlib.Path(self.vector_rows_filepath).exists():
+        vector_rows = np.load(self.vector_rows_filepath)
+        if len(vector_rows) == len(self.store) and (len(vector_rows) == 0 or vector_rows.max() < len(self.embeddings)):
+          self.embeddings = self.embeddings[vector_rows]
+      if len(self.embeddings) == len(self.store):
         return self.embeddings
       print("Cache mismatch. Rebuilding cache...")
-    return self.build_embeddings(documents)
+    return self.build_embeddings(self.store)
   
+  @phase("query")
   def search(self, query: str, limit: int = 5):
-    if self.embeddings is None or self.documents is None:
+    if self.embeddings is None or self.store is None:
       raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
     query_embedding = self.generate_embedding(query)
-    search_result: list[tuple[float, dict]] = []
-    for doc_embedding, doc in tqdm(zip(self.embeddings, self.documents), "Calculating cosine similarity", len(self.documents)):
+    search_result: list[tuple[float, int]] = []
+    for row, doc_embedding in tqdm(enumerate(self.embeddings), "Calculating cosine similarity", len(self.store)):
       similarity_score = cosine_similarity(query_embedding, doc_embedding)
-      search_result.append((similarity_score, doc))
+      search_result.append((similarity_score, row))
     search_result.sort(key=lambda item: item[0], reverse=True)
-    return search_result[:limit]
+    return [(score, self.store.doc(row)) for score, row in search_result[:limit]]
 
 
 def verify_model():
@@ -101,10 +127,11 @@ def cosine_similarity(vec1, vec2):
 
     return dot_product / (norm1 * norm2)
 
-def semantic_search_command(query: str, limit: int = 5):
-  semantic_search = SemanticSearch()
+def semantic_search_command(query: str, limit: int = 5, encoder_backend: str = DEFAULT_ENCODER_BACKEND, num_threads: int | None = None):
+  semantic_search = SemanticSearch(encoder_backend=encoder_backend, num_threads=num_threads)
   movies = load_movies()["movies"]
   semantic_search.load_or_create_embeddings(movies)
+  semantic_search.warm_up()
   search_result = semantic_search.search(query, limit)
   for i, movie in enumerate(search_result):
     abbreviated_description = " ".join(movie[1]['description'].split()[:20])
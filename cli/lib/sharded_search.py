@@ -0,0 +1,189 @@
+from lib.inverted_index import InvertedIndex
+from lib.chunked_semantic_search import ChunkedSemanticSearch
+from lib.hybrid_search import fuse_weighted, fuse_rrf
+from lib.document_store import DocumentStore, as_store
+from lib.query_budget import QueryBudget, plan_depth, record_retrieval
+from lib.profiling import phase
+from search_utils import SCORE_PRECISION
+from data_handling import CACHE_DIR, SHARDS_DIR, DOCUMENTS_FILE
+from multiprocessing.connection import Connection
+from pathlib import Path
+from time import monotonic
+import multiprocessing, os, shutil
+import numpy as np
+
+
+def shard_of(doc_id: int, num_shards: int) -> int:
+  return doc_id % num_shards
+
+def shard_cache_dir(shard: int, num_shards: int) -> str:
+  return os.path.join(CACHE_DIR, SHARDS_DIR, str(num_shards), f"shard-{shard}")
+
+def merge_collection_stats(shard_stats: list[dict]) -> dict:
+  N = sum(s["N"] for s in shard_stats)
+  total_length = sum(s["total_length"] for s in shard_stats)
+  df: dict[str, int] = {}
+  for s in shard_stats:
+    for token, count in s["df"].items():
+      df[token] = df.get(token, 0) + count
+  return {"N": N, "avg_doc_length": total_length / N if N > 0 else 0.0, "df": df}
+
+
+def shard_cache_matches(cache_dir: str, store: DocumentStore) -> bool:
+  # A shard cache built from other documents would map rows to ids the coordinator does not know
+  filepath = Path(cache_dir, DOCUMENTS_FILE)
+  if not filepath.exists():
+    return False
+  cached = DocumentStore.load(filepath)
+  return np.array_equal(cached.ids, store.ids) and np.array_equal(cached.offsets, store.offsets) and cached.buffer == store.buffer
+
+def run_shard_worker(conn: Connection, cache_dir: str, documents: list[dict], impacts: bool):
+  # One shard: its own inverted index and chunk embeddings, serving requests from the coordinator
+  store = as_store(documents)
+  if Path(cache_dir).exists() and not shard_cache_matches(cache_dir, store):
+    print(f"Shard cache {cache_dir} does not match the shard's documents. Rebuilding...")
+    shutil.rmtree(cache_dir)
+  idx = InvertedIndex(cache_dir)
+  idx.build(impacts, documents=store)
+  semantic_search = ChunkedSemanticSearch(cache_dir=cache_dir)
+  semantic_search.load_or_create_chunk_embeddings(idx.store)
+  conn.send(("ok", None))
+  while True:
+    request, *args = conn.recv()
+    try:
+      match request:
+        case "stats":
+          conn.send(("ok", idx.collection_stats()))
+        case "set_stats":
+          idx.set_global_stats(args[0])
+          conn.send(("ok", None))
+        case "search":
+          query, limit = args
+          # Shard rows are local, document ids are what the coordinator understands
+          bm25 = [(idx.store.id_of(row), score) for row, score in idx.bm25_search(query, limit)]
+          # Unrounded scores, so the coordinator can merge exactly
+          semantic = [(idx.store.id_of(row), score) for row, score in semantic_search.rank_movies(query, limit)]
+          conn.send(("ok", (bm25, semantic)))
+        case "close":
+          conn.send(("ok", None))
+          return
+        case _:
+          conn.send(("error", f"unknown request: {request}"))
+    except Exception as e:
+      conn.send(("error", repr(e)))
+
+
+class ShardedSearch:
+  # Scatter-gather over shard worker processes. Shards score BM25 with merged
+  # global statistics, so merging their top-k lists gives the exact global
+  # top-k. Workers talk over multiprocessing connections; Listener/Client
+  # offer the same send/recv interface over TCP for shards on other hosts.
+  def __init__(self, documents: list[dict] | DocumentStore, num_shards: int, impacts: bool = False):
+    # Global rows follow corpus order, so ties break as in a single-process search
+    self.store = as_store(documents)
+    self.num_shards = num_shards
+    self.cache_hit = None
+    context = multiprocessing.get_context("spawn")
+    self.connections: list[Connection] = []
+    self.workers = []
+    # Per shard: replies still due for requests the coordinator stopped waiting for
+    self.stale: list[int] = [0] * num_shards
+    for shard in range(num_shards):
+      shard_docs = [self.store.doc(row) for row in range(len(self.store)) if shard_of(self.store.id_of(row), num_shards) == shard]
+      parent_conn, child_conn = context.Pipe()
+      worker = context.Process(target=run_shard_worker, args=(child_conn, shard_cache_dir(shard, num_shards), shard_docs, impacts), daemon=True)
+      worker.start()
+      self.connections.append(parent_conn)
+      self.workers.append(worker)
+    print(f"Waiting for {num_shards} shard workers...")
+    self.__gather()
+    global_stats = merge_collection_stats(self.__scatter("stats"))
+    self.__scatter("set_stats", global_stats)
+
+  def __gather(self, deadline: float | None = None) -> list:
+    # One payload per shard, None for shards that had not replied by the deadline
+    return [self.__receive(shard, deadline) for shard in range(len(self.connections))]
+
+  def __receive(self, shard: int, deadline: float | None):
+    conn = self.connections[shard]
+    while True:
+      timeout = None if deadline is None else max(0.0, deadline - monotonic())
+      if not conn.poll(timeout):
+        # The reply still arrives later and is skipped then
+        self.stale[shard] += 1
+        return None
+      status, payload = conn.recv()
+      if self.stale[shard] > 0:
+        # Shards answer in order, so this is the reply to an abandoned request
+        self.stale[shard] -= 1
+        continue
+      if status != "ok":
+        raise RuntimeError(f"shard {shard} failed: {payload}")
+      return payload
+
+  def __scatter(self, request: str, *args, deadline: float | None = None) -> list:
+    # Send to every shard first so they work in parallel, then collect
+    for conn in self.connections:
+      conn.send((request, *args))
+    return self.__gather(deadline)
+
+  def retrieve(self, query: str, limit: int, budget: QueryBudget | None = None) -> tuple[list[tuple[int, float]], list[tuple[int, float]], list[str]]:
+    # Merged (global row, score) pairs and degradations, in the same form as HybridSearch.retrieve.
+    # Shards that miss the budget's retrieval deadline are left out of the merge
+    deadline = None if budget is None else monotonic() + budget.available()
+    bm25_results: list[tuple[int, float]] = []
+    semantic_results: list[tuple[int, float]] = []
+    degraded: list[str] = []
+    for shard, reply in enumerate(self.__scatter("search", query, limit, deadline=deadline)):
+      if reply is None:
+        degraded.append(f"shard {shard}")
+        budget.degrade(f"shard {shard} results dropped at the deadline")
+        continue
+      bm25, semantic = reply
+      bm25_results.extend((self.store.row_of(doc_id), score) for doc_id, score in bm25)
+      semantic_results.extend((self.store.row_of(doc_id), score) for doc_id, score in semantic)
+    bm25_results.sort(key=lambda item: (-item[1], item[0]))
+    semantic_results.sort(key=lambda item: (-item[1], item[0]))
+    return bm25_results[:limit], [(row, round(score, SCORE_PRECISION)) for row, score in semantic_results[:limit]], degraded
+
+  def bm25_search(self, query: str, limit: int = 5) -> list[tuple[int, float]]:
+    return self.retrieve(query, limit)[0]
+
+  def cached(self, query: str, key: tuple, search) -> tuple[list[dict], list[str]]:
+    # Shards have no query cache; rerankers call this as on HybridSearch
+    return search()
+
+  def __fused(self, query: str, limit: int, budget: QueryBudget | None) -> tuple[list[tuple[int, float]], list[tuple[int, float]], list[str]]:
+    start = monotonic()
+    depth = plan_depth(limit * 500, limit, budget)
+    bm25_results, semantic_results, degraded = self.retrieve(query, depth, budget)
+    record_retrieval(depth, limit * 500, degraded, start)
+    return bm25_results, semantic_results, degraded
+
+  @phase("query")
+  def weighted_search(self, query, alpha, limit=5, budget: QueryBudget | None = None) -> list[dict]:
+    bm25_results, semantic_results, _ = self.__fused(query, limit, budget)
+    return fuse_weighted(bm25_results, semantic_results, self.store, alpha, limit)
+
+  @phase("query")
+  def rrf_search(self, query, k=60, limit=10, alpha=0.5, budget: QueryBudget | None = None) -> list[dict]:
+    return self.rrf_search_uncached(query, k, limit, budget)[0]
+
+  def rrf_search_uncached(self, query, k=60, limit=10, budget: QueryBudget | None = None) -> tuple[list[dict], list[str]]:
+    bm25_results, semantic_results, degraded = self.__fused(query, limit, budget)
+    return fuse_rrf([ x[0] for x in bm25_results ], [ x[0] for x in semantic_results ], self.store, k, limit), degraded
+
+  def close(self):
+    if len(self.connections) == 0:
+      return
+    self.__scatter("close")
+    for worker in self.workers:
+      worker.join()
+    self.connections = []
+    self.workers = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
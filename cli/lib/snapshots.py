@@ -0,0 +1,202 @@
+from lib.inverted_index import InvertedIndex, index_version
+from lib.chunked_semantic_search import ChunkedSemanticSearch
+from lib.query_expansion import load_or_build_expansions
+from lib.spelling import SpellingCorrector
+from lib.document_store import DocumentStore, as_store
+from search_utils import BM25_K1, BM25_B, SNAPSHOTS_TO_KEEP, SNAPSHOT_POLL_SECONDS
+from data_handling import CACHE_DIR, SNAPSHOTS_DIR, CURRENT_SNAPSHOT_FILE, SNAPSHOT_MANIFEST_FILE, DOCUMENTS_FILE, INDEX_FILE, CHUNK_EMBEDDINGS_FILE, SPELLING_FILE
+from contextlib import contextmanager
+from collections.abc import Callable
+from pathlib import Path
+import hashlib, json, os, shutil, threading, time, uuid
+
+# Caches are written into a temporary directory, renamed into
+# cache/snapshots/<version>/ and published by atomically replacing the
+# CURRENT pointer, so readers only ever see complete snapshots. Published
+# snapshots are never written to; a cache file they lack is an error.
+
+
+def snapshots_root() -> Path:
+  return Path(CACHE_DIR, SNAPSHOTS_DIR)
+
+def snapshot_dir(version: str) -> str:
+  return str(snapshots_root() / version)
+
+def current_snapshot() -> str | None:
+  pointer = snapshots_root() / CURRENT_SNAPSHOT_FILE
+  if not pointer.exists():
+    return None
+  return pointer.read_text().strip() or None
+
+def resolve_cache_dir() -> str:
+  # The published snapshot if there is one, the flat cache directory otherwise
+  version = current_snapshot()
+  return CACHE_DIR if version is None else snapshot_dir(version)
+
+def cache_version(cache_dir: str) -> str:
+  # The snapshot version, or for the flat cache the modification times of its index and embeddings
+  manifest = Path(cache_dir, SNAPSHOT_MANIFEST_FILE)
+  if manifest.exists():
+    with open(manifest) as file:
+      return json.load(file)["version"]
+  stamps = [str(Path(cache_dir, name).stat().st_mtime_ns) for name in (INDEX_FILE, CHUNK_EMBEDDINGS_FILE) if Path(cache_dir, name).exists()]
+  return "flat-" + "-".join(stamps)
+
+def list_snapshots() -> list[str]:
+  if not snapshots_root().exists():
+    return []
+  return sorted(p.name for p in snapshots_root().iterdir() if p.is_dir() and not p.name.startswith("."))
+
+def corpus_hash(documents: list[dict] | DocumentStore) -> str:
+  # Over the fields the document store keeps, so a built snapshot and its loaded store agree
+  return hashlib.sha256(json.dumps(as_store(documents).docs(), sort_keys=True).encode()).hexdigest()
+
+def file_checksum(filepath: Path) -> str:
+  digest = hashlib.sha256()
+  with open(filepath, "rb") as file:
+    for block in iter(lambda: file.read(1 << 20), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+def read_manifest(version: str) -> dict:
+  with open(Path(snapshot_dir(version), SNAPSHOT_MANIFEST_FILE)) as file:
+    return json.load(file)
+
+def check_snapshot_corpus(cache_dir: str, documents: list[dict] | DocumentStore):
+  # A snapshot only serves the corpus it was built from
+  manifest = Path(cache_dir, SNAPSHOT_MANIFEST_FILE)
+  if not manifest.exists():
+    return
+  with open(manifest) as file:
+    expected = json.load(file)["corpus_hash"]
+  if corpus_hash(documents) != expected:
+    raise RuntimeError(f"Snapshot {cache_dir} was built from a different corpus. Rebuild the snapshot with 'hybrid_search_cli.py snapshot-build'")
+
+def verify_snapshot(version: str) -> bool:
+  manifest = read_manifest(version)
+  for name, checksum in manifest["files"].items():
+    filepath = Path(snapshot_dir(version), name)
+    if not filepath.exists() or file_checksum(filepath) != checksum:
+      print(f"Snapshot {version}: checksum mismatch for {name}")
+      return False
+  return True
+
+def publish_snapshot(version: str):
+  pointer = snapshots_root() / CURRENT_SNAPSHOT_FILE
+  tmp_pointer = pointer.with_name(f".{CURRENT_SNAPSHOT_FILE}.{uuid.uuid4().hex}")
+  tmp_pointer.write_text(version)
+  os.replace(tmp_pointer, pointer)
+  print(f"Published snapshot {version}")
+
+def build_snapshot(documents: list[dict], model_name: str = "all-MiniLM-L6-v2", impacts: bool = False, positions: bool = False, expansions: bool = False, reduced_dims: list[int] | None = None, chunker: str | None = None, overlap_tokens: int | None = None) -> str:
+  corpus_digest = corpus_hash(documents)
+  version = f"{time.strftime('%Y%m%d-%H%M%S')}-{corpus_digest[:8]}-{uuid.uuid4().hex[:4]}"
+  snapshots_root().mkdir(parents=True, exist_ok=True)
+  tmp_dir = snapshots_root() / f".tmp-{version}"
+  try:
+    idx = InvertedIndex(str(tmp_dir))
+    idx.build(impacts, positions, documents)
+    semantic_search = ChunkedSemanticSearch(model_name, str(tmp_dir), chunker=chunker, overlap_tokens=overlap_tokens)
+    semantic_search.build_chunk_embeddings(idx.store)
+    for dims in reduced_dims or []:
+      semantic_search.use_reduced_dims(dims)
+    corrector = SpellingCorrector()
+    corrector.build(idx)
+    corrector.save(tmp_dir / SPELLING_FILE, index_version(str(tmp_dir)))
+    if expansions:
+      load_or_build_expansions(idx, semantic_search.model, str(tmp_dir))
+    manifest = {
+      "version": version,
+      "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+      "corpus_hash": corpus_digest,
+      "model_name": model_name,
+      "parameters": {"bm25_k1": BM25_K1, "bm25_b": BM25_B, "impacts": impacts, "positions": positions, "expansions": expansions, "reduced_dims": reduced_dims or [], "chunker": semantic_search.chunker_spec()},
+      "files": {p.name: file_checksum(p) for p in sorted(tmp_dir.iterdir()) if p.is_file()}
+    }
+    with open(tmp_dir / SNAPSHOT_MANIFEST_FILE, "w") as file:
+      json.dump(manifest, file, indent=2)
+    os.rename(tmp_dir, snapshot_dir(version))
+  except BaseException:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    raise
+  publish_snapshot(version)
+  return version
+
+def load_snapshot_documents(version: str) -> DocumentStore:
+  # The document store keeps the corpus order the snapshot was built with
+  return DocumentStore.load(Path(snapshot_dir(version), DOCUMENTS_FILE))
+
+
+class SnapshotManager:
+  # Serves queries from the current snapshot and swaps to a newly published one
+  # without pausing them: the new engine loads on the side, the swap is a
+  # reference assignment, and in-flight queries keep the engine they acquired.
+  # Engines of older snapshots are closed once their last query is done.
+  def __init__(self, load_engine: Callable[[DocumentStore, str], object]) -> None:
+    self.load_engine = load_engine
+    self.lock = threading.Lock()
+    self.version: str | None = None
+    self.engines: dict[str, object] = {}
+    self.in_use: dict[str, int] = {}
+    self.stopped = threading.Event()
+    if not self.refresh():
+      raise ValueError("no published snapshot, build one first")
+
+  @contextmanager
+  def acquire(self):
+    with self.lock:
+      version = self.version
+      engine = self.engines[version]
+      self.in_use[version] = self.in_use.get(version, 0) + 1
+    try:
+      yield engine
+    finally:
+      with self.lock:
+        self.in_use[version] -= 1
+      self.remove_unused()
+
+  def refresh(self) -> bool:
+    version = current_snapshot()
+    if version is None or version == self.version:
+      return False
+    if not verify_snapshot(version):
+      return False
+    engine = self.load_engine(load_snapshot_documents(version), snapshot_dir(version))
+    with self.lock:
+      self.version = version
+      self.engines[version] = engine
+      self.in_use.setdefault(version, 0)
+    print(f"Serving snapshot {version}")
+    self.remove_unused()
+    return True
+
+  def poll(self, seconds: float = SNAPSHOT_POLL_SECONDS):
+    # Refreshes on a background thread, so loading a new snapshot never holds up queries
+    def run():
+      while not self.stopped.wait(seconds):
+        try:
+          self.refresh()
+        except Exception as e:
+          print(f"Could not load the published snapshot: {e!r}")
+    threading.Thread(target=run, name="snapshot-refresh", daemon=True).start()
+
+  def remove_unused(self):
+    # Keep the newest snapshots for other processes, drop older ones nobody here is using
+    with self.lock:
+      retired = [self.engines.pop(v) for v in list(self.engines) if v != self.version and self.in_use.get(v, 0) == 0]
+      keep = set(list_snapshots()[-SNAPSHOTS_TO_KEEP:]) | {self.version, current_snapshot()}
+      stale = [v for v in list_snapshots() if v not in keep and self.in_use.get(v, 0) == 0]
+      for version in stale:
+        self.in_use.pop(version, None)
+    for engine in retired:
+      engine.close()
+    for version in stale:
+      shutil.rmtree(snapshot_dir(version), ignore_errors=True)
+      print(f"Removed snapshot {version}")
+
+  def close(self):
+    self.stopped.set()
+    with self.lock:
+      engines, self.engines = list(self.engines.values()), {}
+    for engine in engines:
+      engine.close()
@@ -0,0 +1,139 @@
+from lib.inverted_index import InvertedIndex
+from lib.profiling import phase
+from text_handling import process_string
+from search_utils import BM25_K1, BM25_B
+from data_handling import CACHE_DIR, BM25_CSR_FILE, ensure_writable_cache
+import numpy as np, math, os
+from pathlib import Path
+
+try:
+  from scipy import sparse
+except ImportError:
+  sparse = None
+
+
+# BM25 scored as a sparse document-term matrix product, for single queries and batches
+class SparseInvertedIndex(InvertedIndex):
+  def __init__(self, cache_dir: str = CACHE_DIR) -> None:
+    super().__init__(cache_dir)
+    self.csr_filepath = os.path.join(cache_dir, BM25_CSR_FILE)
+    self.vocab: dict[str, int] = {}
+    # CSR arrays: row r holds the BM25 weights (tf component * idf) of document row r
+    self.indptr = np.zeros(1, dtype=np.int64)
+    self.indices = np.empty(0, dtype=np.int32)
+    self.data = np.empty(0, dtype=np.float64)
+    self.matrix = None
+
+  def build_matrix(self):
+    self.vocab = {token: i for i, token in enumerate(sorted(self.index))}
+    N = len(self.store)
+    avg_doc_length = sum(self.doc_lengths) / N if N > 0 else 0.0
+    idf = np.zeros(len(self.vocab), dtype=np.float64)
+    for token, i in self.vocab.items():
+      df = len(self.index[token])
+      idf[i] = math.log((N - df + 0.5) / (df + 0.5) + 1)
+    indptr = [0]
+    indices: list[int] = []
+    data: list[float] = []
+    for counts, doc_length in zip(self.term_frequencies, self.doc_lengths):
+      length_norm = 1 - BM25_B + BM25_B * (doc_length / avg_doc_length)
+      for token in sorted(counts, key=self.vocab.__getitem__):
+        tf = counts[token]
+        indices.append(self.vocab[token])
+        data.append((tf * (BM25_K1 + 1)) / (tf + BM25_K1 * length_norm) * idf[self.vocab[token]])
+      indptr.append(len(indices))
+    self.indptr = np.array(indptr, dtype=np.int64)
+    self.indices = np.array(indices, dtype=np.int32)
+    self.data = np.array(data, dtype=np.float64)
+    self.__prepare_matrix()
+
+  def __prepare_matrix(self):
+    if sparse is not None:
+      self.matrix = sparse.csr_matrix((self.data, self.indices, self.indptr), shape=(len(self.indptr) - 1, len(self.vocab)))
+
+  def query_vector(self, query: str, expansions: dict[str, float] | None = None) -> np.ndarray:
+    q = np.zeros(len(self.vocab), dtype=np.float64)
+    tokens = process_string(query)
+    for token in tokens:
+      if token in self.vocab:
+        q[self.vocab[token]] += 1
+    for token, weight in (expansions or {}).items():
+      if token in self.vocab and token not in tokens:
+        q[self.vocab[token]] += weight
+    return q
+
+  def score_batch(self, queries: list[str], expansions: list[dict[str, float] | None] | None = None) -> np.ndarray:
+    # (n_docs, n_queries) matrix of BM25 scores
+    expansions = expansions or [None] * len(queries)
+    Q = np.stack([self.query_vector(q, e) for q, e in zip(queries, expansions)], axis=1)
+    if self.matrix is not None:
+      return np.asarray(self.matrix @ Q)
+    # Row sums via a prefix sum over the non-zeros: empty rows come out as 0
+    contributions = self.data[:, None] * Q[self.indices]
+    prefix = np.zeros((len(self.data) + 1, len(queries)), dtype=np.float64)
+    np.cumsum(contributions, axis=0, out=prefix[1:])
+    return prefix[self.indptr[1:]] - prefix[self.indptr[:-1]]
+
+  def __top(self, scores: np.ndarray, limit: int) -> list[tuple[int, float]]:
+    # Stable sort keeps ties in row order, like the dict backend
+    top_rows = np.argsort(-scores, kind="stable")[:limit]
+    return [(int(r), float(scores[r])) for r in top_rows]
+
+  @phase("query")
+  def bm25_search(self, query: str, limit: int = 5, k1: float = BM25_K1, b: float = BM25_B, phrases: list[tuple[str, int]] | None = None, expansions: dict[str, float] | None = None):
+    if k1 != BM25_K1 or b != BM25_B or phrases:
+      # The matrix is built for the default parameters only, and phrases score a small candidate set
+      return super().bm25_search(query, limit, k1, b, phrases, expansions)
+    return self.__top(self.score_batch([query], [expansions])[:, 0], limit)
+
+  @phase("query")
+  def bm25_search_batch(self, queries: list[str], limit: int = 5) -> list[list[tuple[int, float]]]:
+    if len(queries) == 0:
+      return []
+    scores = self.score_batch(queries)
+    return [self.__top(scores[:, i], limit) for i in range(len(queries))]
+
+  @phase("cache load")
+  def build(self, impacts: bool = False, positions: bool = False, documents: list[dict] | None = None):
+    super().build(impacts, positions, documents)
+    if len(self.vocab) == 0:
+      self.build_matrix()
+      self.save_matrix()
+
+  def save_matrix(self):
+    Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+    with open(self.csr_filepath, "wb") as file:
+      np.savez(file, vocab=np.array(sorted(self.vocab, key=self.vocab.__getitem__)), num_rows=len(self.indptr) - 1,
+               indptr=self.indptr, indices=self.indices, data=self.data)
+
+  @phase("cache load")
+  def load(self):
+    super().load()
+    if not Path(self.csr_filepath).exists():
+      ensure_writable_cache(self.cache_dir, "no CSR matrix")
+      print("CSR matrix missing from cache. Building...")
+      self.build_matrix()
+      self.save_matrix()
+      return
+    with np.load(self.csr_filepath) as cached:
+      if int(cached["num_rows"]) != len(self.store):
+        ensure_writable_cache(self.cache_dir, "the CSR matrix does not match the index")
+        print("CSR matrix does not match the index. Rebuilding...")
+        self.build_matrix()
+        self.save_matrix()
+        return
+      self.vocab = {str(token): i for i, token in enumerate(cached["vocab"])}
+      self.indptr = cached["indptr"]
+      self.indices = cached["indices"]
+      self.data = cached["data"]
+    self.__prepare_matrix()
+
+
+def create_inverted_index(backend: str = "dict", cache_dir: str = CACHE_DIR) -> InvertedIndex:
+  match backend:
+    case "dict":
+      return InvertedIndex(cache_dir)
+    case "csr":
+      return SparseInvertedIndex(cache_dir)
+    case _:
+      raise ValueError(f"unknown BM25 backend: {backend}")
@@ -0,0 +1,131 @@
+from lib.inverted_index import InvertedIndex, index_version
+from lib.profiling import phase
+from text_handling import normalize_string, process_string
+from data_handling import CACHE_DIR, SPELLING_FILE, load_stopwords, ensure_writable_cache
+from search_utils import SPELLING_MAX_EDIT_DISTANCE, SPELLING_PREFIX_LENGTH
+from collections import Counter
+from pathlib import Path
+import pickle
+
+# Symmetric delete spelling correction (SymSpell): every vocabulary word is
+# indexed under all strings reachable by deleting up to max_distance characters
+# from its prefix. A query word generates its own deletes and looks them up,
+# so candidates come from a few dictionary lookups instead of a vocabulary scan.
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+  # Optimal string alignment distance (adjacent transpositions count once); max_distance + 1 once it is exceeded
+  if abs(len(a) - len(b)) > max_distance:
+    return max_distance + 1
+  previous2: list[int] = []
+  previous = list(range(len(b) + 1))
+  for i in range(1, len(a) + 1):
+    current = [i] + [0] * len(b)
+    for j in range(1, len(b) + 1):
+      cost = 0 if a[i - 1] == b[j - 1] else 1
+      current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+      if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+        current[j] = min(current[j], previous2[j - 2] + 1)
+    if min(current) > max_distance:
+      return max_distance + 1
+    previous2, previous = previous, current
+  return previous[-1]
+
+def generate_deletes(word: str, max_distance: int) -> set[str]:
+  deletes: set[str] = set()
+  frontier = {word}
+  for _ in range(max_distance):
+    frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))} - deletes
+    deletes |= frontier
+  return deletes
+
+
+class SpellingCorrector:
+  def __init__(self, max_distance: int = SPELLING_MAX_EDIT_DISTANCE, prefix_length: int = SPELLING_PREFIX_LENGTH) -> None:
+    self.max_distance = max_distance
+    self.prefix_length = prefix_length
+    # word -> number of documents it appears in
+    self.word_counts: dict[str, int] = {}
+    # delete string -> vocabulary words it was generated from
+    self.deletes: dict[str, list[str]] = {}
+    # Index tokens, so inflections absent from the documents are not "corrected"
+    self.vocabulary: set[str] = set()
+    self.stopwords = set(load_stopwords())
+
+  def build(self, idx: InvertedIndex):
+    # Surface words of the indexed documents whose stem is in the index vocabulary, so
+    # corrections stay readable for the semantic retriever and match BM25 tokens
+    counts: Counter[str] = Counter()
+    for row in range(len(idx.store)):
+      counts.update(set(normalize_string(idx.store.text(row)).split()))
+    self.vocabulary = set(idx.index)
+    self.word_counts = {}
+    for word, count in counts.items():
+      tokens = process_string(word)
+      if len(tokens) == 1 and tokens[0] in idx.index:
+        self.word_counts[word] = count
+    self.deletes = {}
+    for word in self.word_counts:
+      prefix = word[:self.prefix_length]
+      for delete in generate_deletes(prefix, self.max_distance) | {prefix}:
+        self.deletes.setdefault(delete, []).append(word)
+    print(f"Spelling dictionary: {len(self.word_counts)} words, {len(self.deletes)} deletes")
+
+  def lookup(self, word: str, limit: int = 5) -> list[tuple[str, int, int]]:
+    # (suggestion, edit distance, document frequency), closest first, then most frequent
+    if word in self.word_counts:
+      return [(word, 0, self.word_counts[word])]
+    prefix = word[:self.prefix_length]
+    seen: set[str] = set()
+    suggestions: list[tuple[str, int, int]] = []
+    for delete in generate_deletes(prefix, self.max_distance) | {prefix}:
+      for candidate in self.deletes.get(delete, []):
+        if candidate in seen:
+          continue
+        seen.add(candidate)
+        distance = edit_distance(word, candidate, self.max_distance)
+        if distance <= self.max_distance:
+          suggestions.append((candidate, distance, self.word_counts[candidate]))
+    suggestions.sort(key=lambda item: (item[1], -item[2], item[0]))
+    return suggestions[:limit]
+
+  def correct_query(self, query: str) -> str:
+    # Known words, stopwords and numbers are kept, every other word becomes its best suggestion
+    corrected: list[str] = []
+    for word in normalize_string(query).split():
+      if word in self.word_counts or word in self.stopwords or word.isdigit() or set(process_string(word)) <= self.vocabulary:
+        corrected.append(word)
+        continue
+      suggestions = self.lookup(word, 1)
+      corrected.append(suggestions[0][0] if suggestions else word)
+    return " ".join(corrected)
+
+  def save(self, filepath: str | Path, version: str | None):
+    with open(filepath, "wb") as file:
+      pickle.dump({"index_version": version, "max_distance": self.max_distance, "prefix_length": self.prefix_length, "word_counts": self.word_counts, "deletes": self.deletes, "vocabulary": self.vocabulary}, file)
+
+  def load(self, filepath: str | Path, version: str | None) -> bool:
+    # A dictionary built from another index or with other parameters is stale
+    with open(filepath, "rb") as file:
+      cached = pickle.load(file)
+    if cached.get("index_version") != version or cached["max_distance"] != self.max_distance or cached["prefix_length"] != self.prefix_length:
+      return False
+    self.word_counts = cached["word_counts"]
+    self.deletes = cached["deletes"]
+    self.vocabulary = cached["vocabulary"]
+    return True
+
+
+@phase("cache load")
+def load_or_build_spelling(cache_dir: str = CACHE_DIR) -> SpellingCorrector:
+  corrector = SpellingCorrector()
+  filepath = Path(cache_dir, SPELLING_FILE)
+  if filepath.exists() and corrector.load(filepath, index_version(cache_dir)):
+    return corrector
+  ensure_writable_cache(cache_dir, "the spelling dictionary is missing or was built from another index")
+  print("Building spelling dictionary from the inverted index...")
+  idx = InvertedIndex(cache_dir)
+  idx.build()
+  corrector.build(idx)
+  corrector.save(filepath, index_version(cache_dir))
+  return corrector
@@ -1,6 +1,56 @@
 BM25_K1 = 1.5
 BM25_B = 0.75
+BM25_IMPACT_LEVELS = 255
+BM25_BACKENDS = ["dict", "csr"]
+TOKEN_SCORE_CACHE_SIZE = 256
+FUSED_RESULT_CACHE_SIZE = 32
+# Upper bound on retriever threads per HybridSearch; threads start only when none is idle
+RETRIEVER_WORKERS = 16
+SNAPSHOTS_TO_KEEP = 2
+# Seconds between checks for a newly published snapshot while serving
+SNAPSHOT_POLL_SECONDS = 5
 DEFAULT_SEMANTIC_SEARCH_LIMIT = 5
 DEFAULT_CHUNK_SIZE = 200
 MAX_SEMANTIC_CHUNK_SIZE = 4
-SCORE_PRECISION = 2
\ No newline at end of file
+SCORE_PRECISION = 2
+CHUNK_POOLING_METHODS = ["max", "mean", "top2"]
+DEFAULT_CHUNK_POOLING = "max"
+ENCODE_BATCH_SIZE = 64
+ENCODE_CHECKPOINT_EVERY = 10
+ENCODER_BACKENDS = ["float32", "int8"]
+DEFAULT_ENCODER_BACKEND = "float32"
+LLM_PROMPT_TOKEN_BUDGET = 1500
+LLM_DESCRIPTION_TOKENS = 60
+LLM_RERANK_WORKERS = 4
+REDUCED_DIMENSIONS = [64, 128]
+REDUCED_RESCORE_FACTOR = 4
+REDUCED_MIN_CANDIDATES = 100
+# Movies hybrid search rescores with full vectors; its semantic list is far deeper than any shown
+HYBRID_RESCORE_DEPTH = 300
+SPELLING_MAX_EDIT_DISTANCE = 2
+SPELLING_PREFIX_LENGTH = 7
+EXPANSION_MIN_DF = 2
+EXPANSION_MAX_DF_RATIO = 0.5
+EXPANSION_MIN_COOCCURRENCE = 2
+EXPANSION_NEIGHBOURS = 10
+EXPANSION_COOCCURRENCE_SHARE = 0.5
+EXPANSION_MIN_SIMILARITY = 0.3
+EXPANSION_TERMS = 3
+EXPANSION_WEIGHT = 0.5
+EXPANSION_BLOCK_SIZE = 1024
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_THRESHOLD = 0.92
+# Seconds per stage before any are measured; individual reranking is per candidate
+BUDGET_STAGE_SECONDS = {"retrieve": 0.5, "individual": 4.0, "batch": 6.0, "cross_encoder": 2.0}
+BUDGET_ESTIMATE_SMOOTHING = 0.3
+BUDGET_MIN_DEPTH_FACTOR = 20
+BUDGET_RESCORE_DEPTH = 100
+RERANK_FALLBACKS = {"individual": "cross_encoder", "batch": "cross_encoder", "cross_encoder": None}
+CHUNKERS = ["tokens", "sentences"]
+DEFAULT_CHUNKER = "tokens"
+CHUNK_TOKEN_OVERLAP = 32
+PROFILE_TOP_FUNCTIONS = 25
+PROFILE_TOP_ALLOCATIONS = 10
+# Collapsed stacks drop shares of self time below this, and stop climbing callers past this depth
+PROFILE_MIN_STACK_SECONDS = 1e-4
+PROFILE_MAX_STACK_DEPTH = 64
\ No newline at end of file
@@ -2,12 +2,15 @@
 
 from lib.semantic_search import *
 from search_utils import *
-from lib.chunked_semantic_search import embed_chunks_command, semantic_chunking, search_chunked_command
+from lib.chunked_semantic_search import embed_chunks_command, semantic_chunking, token_chunking, chunk_token_limit, search_chunked_command, reduced_dims_report
+from lib.encoders import encoder_report
+from lib.profiling import add_profile_arguments, profile_session
 
 import argparse
 
 def main():
   parser = argparse.ArgumentParser(description="Semantic Search CLI")
+  add_profile_arguments(parser)
   subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
   # Verify model command
@@ -28,6 +31,8 @@ def main():
   search_subparser = subparsers.add_parser("search", help="perform a semantic search")
   search_subparser.add_argument("query", help="query for the search")
   search_subparser.add_argument("--limit", type=int, nargs="?", default=DEFAULT_SEMANTIC_SEARCH_LIMIT, help="tunable limit for top results to display")
+  search_subparser.add_argument("--encoder", type=str, choices=ENCODER_BACKENDS, default=DEFAULT_ENCODER_BACKEND, help="query encoder: full float32 model or dynamically quantized int8 (CPU)")
+  search_subparser.add_argument("--threads", type=int, help="intra-op CPU threads for the query encoder")
 
   # chunk command
   chunk_subparser = subparsers.add_parser("chunk", help="Splits a string into chunks. Default 200 words.")
@@ -41,17 +46,47 @@ def main():
   semantic_chunk_subparser.add_argument("--max-chunk-size", type=int, nargs="?", default=MAX_SEMANTIC_CHUNK_SIZE, help="maximum chunk size in words")
   semantic_chunk_subparser.add_argument("--overlap", type=int, nargs="?", default=0, help="chunk overlap in words")
 
+  # Token chunk command
+  token_chunk_subparser = subparsers.add_parser("token_chunk", help="Packs sentences into chunks measured with the model tokenizer")
+  token_chunk_subparser.add_argument("text", help="text to chunk")
+  token_chunk_subparser.add_argument("--max-tokens", type=int, help="maximum chunk size in tokens (default: the model's max sequence length minus special tokens)")
+  token_chunk_subparser.add_argument("--overlap-tokens", type=int, default=CHUNK_TOKEN_OVERLAP, help=f"tokens of trailing sentences repeated in the next chunk (default {CHUNK_TOKEN_OVERLAP})")
+
   # Embed chunks command
-  subparsers.add_parser("embed_chunks", help="Embed some chunks")
+  embed_chunks_subparser = subparsers.add_parser("embed_chunks", help="Embed some chunks")
+  embed_chunks_subparser.add_argument("--reduced-dims", type=int, nargs="+", help="also fit PCA projections of the chunk embeddings to these dimensions")
+  embed_chunks_subparser.add_argument("--chunker", type=str, choices=CHUNKERS, help=f"tokens: sentences packed up to the model's max sequence length; sentences: 4 sentences with 1 overlap (default: as cached, else {DEFAULT_CHUNKER})")
+  embed_chunks_subparser.add_argument("--overlap-tokens", type=int, help=f"token chunker overlap (default: as cached, else {CHUNK_TOKEN_OVERLAP})")
 
   # Search chunked command
   search_chunked_subparser = subparsers.add_parser("search_chunked", help="search chunked database")
   search_chunked_subparser.add_argument("query", help="query for the search")
   search_chunked_subparser.add_argument("--limit", type=int, nargs="?", default=10, help="limit for the results to display")
+  search_chunked_subparser.add_argument("--pooling", type=str, choices=CHUNK_POOLING_METHODS, default=DEFAULT_CHUNK_POOLING, help="how chunk scores combine into a movie score (default max)")
+  search_chunked_subparser.add_argument("--encoder", type=str, choices=ENCODER_BACKENDS, default=DEFAULT_ENCODER_BACKEND, help="query encoder: full float32 model or dynamically quantized int8 (CPU)")
+  search_chunked_subparser.add_argument("--threads", type=int, help="intra-op CPU threads for the query encoder")
+  search_chunked_subparser.add_argument("--reduced-dims", type=int, help="search a PCA projection with this many dimensions first, then rescore the top movies with full vectors")
+  search_chunked_subparser.add_argument("--chunker", type=str, choices=CHUNKERS, help="chunker the embeddings were built with (default: as cached)")
+  search_chunked_subparser.add_argument("--overlap-tokens", type=int, help="token chunker overlap the embeddings were built with (default: as cached)")
+
+  # Encoder report command
+  encoder_report_subparser = subparsers.add_parser("encoder_report", help="Compare int8 and float32 query encoders on the golden dataset: cosine drift and latency")
+  encoder_report_subparser.add_argument("--threads", type=int, help="intra-op CPU threads")
+  encoder_report_subparser.add_argument("--repeats", type=int, default=5, help="timed encodes per query")
+
+  # Reduced dimensions report command
+  reduced_dims_report_subparser = subparsers.add_parser("reduced_dims_report", help="Compare reduced-dimension first-stage search with the full search on the golden dataset: recall@k and latency")
+  reduced_dims_report_subparser.add_argument("--dims", type=int, nargs="+", default=REDUCED_DIMENSIONS, help="reduced dimensions to compare (default 64 128)")
+  reduced_dims_report_subparser.add_argument("--limit", type=int, default=10, help="k for recall@k")
+  reduced_dims_report_subparser.add_argument("--repeats", type=int, default=5, help="timed searches per query")
 
   # Parse arguments
   args = parser.parse_args()
+  with profile_session(args, "semantic_search_cli"):
+    run_command(args, parser)
+
 
+def run_command(args: argparse.Namespace, parser: argparse.ArgumentParser) -> None:
   match args.command:
     case "verify":
       verify_model()
@@ -66,7 +101,7 @@ def main():
       embed_query_text(args.query)
 
     case "search":
-      semantic_search_command(args.query, args.limit)
+      semantic_search_command(args.query, args.limit, args.encoder, args.threads)
 
     case "chunk":
       chunks = fixed_size_chunking(args.text, args.chunk_size, args.overlap)
@@ -80,16 +115,29 @@ def main():
       for i, chunk in enumerate(chunks):
         print(f"{i+1}. {chunk}")
 
+    case "token_chunk":
+      model = SentenceTransformer("all-MiniLM-L6-v2")
+      max_tokens = chunk_token_limit(model) if args.max_tokens is None else args.max_tokens
+      print(f"Chunking {len(args.text)} characters into chunks of at most {max_tokens} tokens:")
+      for i, (chunk, tokens) in enumerate(token_chunking(args.text, model.tokenizer, max_tokens, args.overlap_tokens)):
+        print(f"{i+1}. ({tokens} tokens) {chunk}")
+
     case "embed_chunks":
-      embeddings = embed_chunks_command()
-      print(f"Generated {len(embeddings)} chunked embeddings")
+      embeddings = embed_chunks_command(args.reduced_dims, args.chunker, args.overlap_tokens)
+      print(f"Generated {len(embeddings)} unique chunked embeddings")
 
     case "search_chunked":
-      movies = search_chunked_command(args.query, args.limit)
+      movies = search_chunked_command(args.query, args.limit, args.pooling, args.encoder, args.threads, args.reduced_dims, args.chunker, args.overlap_tokens)
       for i, m in enumerate(movies):
         print(f"\n{i+1}. {m['title']} (score: {m['score']:.4f})")
         print(f"   {m['document']}...")
 
+    case "encoder_report":
+      encoder_report(num_threads=args.threads, repeats=args.repeats)
+
+    case "reduced_dims_report":
+      reduced_dims_report(args.dims, args.limit, args.repeats)
+
     case _:
       parser.print_help()
 
@@ -1,6 +1,9 @@
 from string import punctuation
 from data_handling import load_stopwords
 from nltk.stem import PorterStemmer
+import re
+
+PHRASE_PATTERN = re.compile(r'"([^"]+)"(?:~(\d+))?')
 
 def normalize_string(keywords: str) -> str:
   processed = keywords.lower()
@@ -29,6 +32,11 @@ def stem_words(words: list[str]) -> list[str]:
 def process_string(text: str) -> list[str]:
   return stem_words(remove_stopwords(tokenize_string(normalize_string(text))))
 
+def parse_phrase_query(query: str) -> tuple[str, list[tuple[str, int]]]:
+  # '"dark knight"~2 batman' -> ("batman", [("dark knight", 2)])
+  phrases = [(m.group(1), int(m.group(2) or 0)) for m in PHRASE_PATTERN.finditer(query)]
+  return PHRASE_PATTERN.sub(" ", query).strip(), phrases
+
 if __name__ == '__main__':
   text = "grizzly"
   print(process_string(text))
\ No newline at end of file